@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Benchmark crop_products.py on synthetic catalogs.
+
+Generates 1241 x 1754 catalog pages, a matching catalog.json and page
+configs at several scales, then runs the crop loop in each mode in a fresh
+process and records throughput (crops/sec), peak RSS and output bytes.
+Peak RSS is the VmHWM of the run and of each of its worker processes,
+summed (an upper bound: forked workers share pages with the run).
+Results are saved as JSON; pass an earlier result file to --compare to flag
+regressions before a catalog refresh.
+
+    python bench_crop_products.py                      # 45 and 500 pages
+    python bench_crop_products.py --scales 45,500,5000 --modes serial,jobs
+    python bench_crop_products.py --compare bench-results/old.json
+
+Pages are hard links to a small pool of distinct templates, so even the
+5,000-page catalog needs only a few MB of disk.
+"""
+import argparse
+import json
+import multiprocessing.util
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import numpy as np
+from PIL import Image
+
+import crop_products
+
+DEFAULT_SCALES = (45, 500)
+TEMPLATES = 8
+WORDS = ("panda", "deli", "soup", "container", "lid", "round", "black",
+         "clear", "foam", "tray", "sauce", "rice", "oil", "bag", "heavy",
+         "duty", "oz", "set", "case", "kraft", "box", "cup", "pail")
+LAYOUTS = ((3, 3, 0.55), (4, 3, 0.55), (2, 3, 0.60), (3, 2, 0.55),
+           (4, 4, 0.50))
+
+# mode name -> extra crop_products arguments
+MODES = {
+    "serial": [],
+    "batch": ["--batch"],
+    "jobs": ["--jobs", "0"],
+    "pipeline": ["--pipeline"],
+    "incremental": [],  # rerun of serial over its own output: all skipped
+}
+DEFAULT_MODES = ("serial", "batch", "jobs", "pipeline", "incremental")
+
+
+def synthetic_page(rng, rows, cols, photo_ratio, content_area):
+    """A white page with a header, a grid of noisy 'photos' and caption bars."""
+    h, w = crop_products.IMG_H, crop_products.IMG_W
+    page = np.full((h, w, 3), 255, dtype=np.uint8)
+    page[40:200, 30:w - 30] = rng.integers(0, 255, 3, dtype=np.uint8)
+
+    top, left, bottom, right = content_area
+    cell_w = (right - left) / cols
+    cell_h = (bottom - top) / rows
+    for row in range(rows):
+        for col in range(cols):
+            x1 = int(left + col * cell_w) + 20
+            x2 = int(left + (col + 1) * cell_w) - 20
+            y1 = int(top + row * cell_h) + 15
+            y2 = int(top + row * cell_h + cell_h * photo_ratio) - 10
+            base = rng.integers(40, 220, 3)
+            ramp = np.linspace(-30, 30, x2 - x1)[None, :, None]
+            noise = rng.normal(0, 6, (y2 - y1, x2 - x1, 3))
+            page[y1:y2, x1:x2] = np.clip(base + ramp + noise, 0, 255)
+            # caption lines under the photo
+            for line in range(3):
+                ty = y2 + 20 + line * 18
+                page[ty:ty + 8, x1:x1 + int((x2 - x1) * 0.7)] = 30
+    return Image.fromarray(page)
+
+
+def build_dataset(root, pages, seed=0):
+    """
+    Write a synthetic catalog under root: images/page-NN.png,
+    catalog.json and configs.json (PAGE_CONFIGS as JSON).
+    Returns the number of products.
+    """
+    rng = np.random.default_rng(seed)
+    images = os.path.join(root, "images")
+    os.makedirs(images, exist_ok=True)
+
+    templates = []
+    for t in range(TEMPLATES):
+        rows, cols, ratio = LAYOUTS[t % len(LAYOUTS)]
+        content_area = (260, 20, 1560, 1220)
+        path = os.path.join(root, f"template-{t}.png")
+        synthetic_page(rng, rows, cols, ratio, content_area).save(path)
+        templates.append((path, rows, cols, ratio, content_area))
+
+    configs = {}
+    categories = {}
+    for page_num in range(1, pages + 1):
+        path, rows, cols, ratio, content_area = templates[
+            page_num % len(templates)]
+        os.link(path, os.path.join(images, f"page-{page_num:02d}.png"))
+        ids = [f"syn{page_num}-{i:02d}" for i in range(rows * cols)]
+        configs[page_num] = {
+            "mode": "grid", "content_area": content_area,
+            "rows": rows, "cols": cols, "photo_ratio": ratio,
+            "products": ids,
+        }
+        cat = categories.setdefault(page_num % 20, [])
+        for pid in ids:
+            name = " ".join(rng.choice(WORDS, 4)) + f" {pid}"
+            cat.append({"id": pid, "name": name.title(), "nameZh": "熊猫"})
+
+    catalog = {"categories": [
+        {"name": f"Category {k}", "nameZh": "类", "products": prods}
+        for k, prods in sorted(categories.items())]}
+    with open(os.path.join(root, "catalog.json"), "w") as f:
+        json.dump(catalog, f, ensure_ascii=False)
+    with open(os.path.join(root, "configs.json"), "w") as f:
+        json.dump(configs, f)
+    return sum(len(c["products"]) for c in configs.values())
+
+
+def peak_rss_mb():
+    """Peak RSS of this process (VmHWM) in MB, or None without /proc."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024 / 1e6
+    except OSError:
+        pass
+    return None
+
+
+def record_peak_rss(path):
+    peak = peak_rss_mb()
+    if peak is not None:
+        with open(path, "w") as f:
+            f.write(str(peak))
+
+
+def run_child(root, output, rss_dir, args):
+    """
+    Entry point of the --_child process: crop one synthetic catalog. The
+    peak RSS of this process and of every --jobs worker forked from it is
+    written to a file in rss_dir as it exits. (ru_maxrss of the child, as
+    wait4 reports it, starts from the RSS of the benchmark process at fork.)
+    """
+    with open(os.path.join(root, "configs.json")) as f:
+        configs = json.load(f)
+    crop_products.IMAGES_DIR = os.path.join(root, "images")
+    crop_products.CATALOG_PATH = os.path.join(root, "catalog.json")
+    crop_products.OUTPUT_DIR = output
+    crop_products.PAGE_CONFIGS = {int(k): v for k, v in configs.items()}
+    # Runs in each worker process after it is forked; the finalizer runs
+    # when the worker exits normally at executor shutdown.
+    multiprocessing.util.register_after_fork(
+        record_peak_rss, lambda _: multiprocessing.util.Finalize(
+            None, record_peak_rss,
+            args=(os.path.join(rss_dir, f"worker-{os.getpid()}"),),
+            exitpriority=0))
+    crop_products.main(args)
+    record_peak_rss(os.path.join(rss_dir, "main"))
+
+
+def output_bytes(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            total += os.path.getsize(os.path.join(dirpath, name))
+    return total
+
+
+def run_mode(root, output, args):
+    """Run one crop in a child process; returns (wall seconds, peak RSS MB)."""
+    rss_dir = tempfile.mkdtemp(prefix="crop-bench-rss-")
+    cmd = [sys.executable, os.path.abspath(__file__), "--_child", root,
+           output, rss_dir, "--", *args]
+    try:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        if os.waitstatus_to_exitcode(status) != 0:
+            raise RuntimeError(f"benchmark run failed: {' '.join(cmd)}")
+        peaks = []
+        for name in os.listdir(rss_dir):
+            with open(os.path.join(rss_dir, name)) as f:
+                peaks.append(float(f.read()))
+    finally:
+        shutil.rmtree(rss_dir, ignore_errors=True)
+    if peaks:
+        return wall, sum(peaks)
+    # No /proc: ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return wall, rusage.ru_maxrss * scale / 1e6
+
+
+def micro_benchmarks(root):
+    """Operations per second of the building blocks, in this process."""
+    with open(os.path.join(root, "catalog.json")) as f:
+        names = [p["name"] for c in json.load(f)["categories"]
+                 for p in c["products"]][:1000]
+    config = {"mode": "grid", "content_area": (260, 20, 1560, 1220),
+              "rows": 4, "cols": 3, "photo_ratio": 0.55,
+              "products": ["x"] * 12}
+    img = Image.open(os.path.join(root, "images", "page-01.png"))
+    img.load()
+
+    def rate(fn, calls):
+        seconds = min(timeit.repeat(fn, number=1, repeat=3))
+        return calls / seconds
+
+    return {
+        "slugify_per_s": rate(lambda: [crop_products.slugify(n)
+                                       for n in names], len(names)),
+        "grid_box_per_s": rate(lambda: [crop_products.grid_box(
+            config["content_area"], 4, 3, i, 0.55) for i in range(12)], 12),
+        "page_boxes_per_s": rate(
+            lambda: crop_products.page_boxes(config), 1),
+        "crop_grid_per_s": rate(lambda: [crop_products.crop_grid(
+            img, config["content_area"], 4, 3, i, 0.55) for i in range(12)],
+            12),
+        "crop_region_per_s": rate(lambda: [crop_products.crop_region(
+            img, (300, 20 + 100 * i, 600, 120 + 100 * i)) for i in range(12)],
+            12),
+    }
+
+
+def compare(results, baseline_path, tolerance):
+    """Print per-run changes against a saved result; return regressions."""
+    with open(baseline_path) as f:
+        baseline = {(r["scale"], r["mode"]): r for r in json.load(f)["runs"]}
+    regressions = []
+    print(f"\nCompared with {baseline_path}:")
+    for run in results["runs"]:
+        old = baseline.get((run["scale"], run["mode"]))
+        if not old:
+            continue
+        speed = run["crops_per_s"] / old["crops_per_s"] - 1
+        rss = run["peak_rss_mb"] / old["peak_rss_mb"] - 1
+        flag = ""
+        if speed < -tolerance or rss > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(run)
+        print(f"  {run['scale']:>5} pages {run['mode']:<12} "
+              f"speed {speed:+.1%}  peak RSS {rss:+.1%}{flag}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark crop_products.py on synthetic catalogs.")
+    parser.add_argument(
+        "--scales", default=",".join(map(str, DEFAULT_SCALES)),
+        help="catalog sizes in pages (default %(default)s; 5000 also works)")
+    parser.add_argument(
+        "--modes", default=",".join(DEFAULT_MODES),
+        help="modes to run, from %s (default all)" % ",".join(MODES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--out", help="result file (default bench-results/crop-<time>.json)")
+    parser.add_argument("--workdir", help="where to build the catalogs "
+                        "(default: a temporary directory, removed afterwards)")
+    parser.add_argument("--compare", metavar="RESULT.json",
+                        help="compare with an earlier result file")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed slowdown or RSS growth before a run "
+                             "counts as a regression (default 0.10)")
+    args = parser.parse_args(argv)
+    args.scales = [int(s) for s in args.scales.split(",") if s]
+    args.modes = [m for m in args.modes.split(",") if m]
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error(f"unknown mode {mode!r}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="crop-bench-")
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pillow": Image.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "seed": args.seed,
+        },
+        "runs": [],
+    }
+
+    try:
+        for scale in args.scales:
+            root = os.path.join(workdir, f"catalog-{scale}")
+            shutil.rmtree(root, ignore_errors=True)
+            crops = build_dataset(root, scale, args.seed)
+            print(f"{scale} pages, {crops} crops ({root})")
+            if "micro" not in results:
+                results["micro"] = micro_benchmarks(root)
+
+            for mode in args.modes:
+                # incremental reruns over the serial output
+                name = "serial" if mode == "incremental" else mode
+                output = os.path.join(root, f"out-{name}")
+                if mode != "incremental":
+                    shutil.rmtree(output, ignore_errors=True)
+                wall, rss = run_mode(root, output, MODES[mode])
+                run = {
+                    "scale": scale, "mode": mode, "crops": crops,
+                    "wall_s": round(wall, 3),
+                    "crops_per_s": round(crops / wall, 1),
+                    "peak_rss_mb": round(rss, 1),
+                    "output_bytes": output_bytes(output),
+                }
+                results["runs"].append(run)
+                print(f"  {mode:<12} {run['wall_s']:>8.2f}s "
+                      f"{run['crops_per_s']:>9.1f} crops/s "
+                      f"{run['peak_rss_mb']:>8.1f} MB RSS "
+                      f"{run['output_bytes'] / 1e6:>9.1f} MB out")
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    out = args.out or os.path.join(
+        "bench-results", time.strftime("crop-%Y%m%d-%H%M%S.json"))
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults -> {out}")
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--_child":
+        run_child(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[6:])
+    else:
+        main()
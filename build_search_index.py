@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Build a precomputed search index for CatalogSearch from catalog.json.
+
+The index is written to public/search-index.json so the site can fetch it
+lazily on the first keystroke instead of scanning every product:
+
+    {"header": {"version", "catalog", "products", "terms", "bytes"},
+     "products": [product_id, ...],          # catalog order
+     "categories": [name, ...],
+     "productCategory": [category index per product],
+     "terms": [term, ...],                   # sorted, for prefix search
+     "postings": [[product index, ...] per term],
+     "grams": {trigram: [term index, ...]},  # substring search in terms
+     "zh": {char or char bigram: [product index, ...]}}
+
+English text (name and category) is lowercased, stripped of accents and
+split into alphanumeric terms. A query term of 1-2 characters is a prefix
+lookup (binary search in "terms"); longer ones intersect the term lists of
+their trigrams, then check the candidates with includes(). Chinese names are
+indexed by single characters and character bigrams. "bytes" in the header is
+the size of the whole file, and "catalog" the sha256 of the catalog it was
+built from, for cache busting.
+
+    python build_search_index.py
+    python build_search_index.py --catalog other.json --out /tmp/index.json
+
+npm runs it before every dev server and build (predev, prebuild in
+package.json), so the index is not committed and cannot go stale.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import unicodedata
+
+CATALOG_PATH = "src/data/catalog.json"
+INDEX_PATH = "public/search-index.json"
+INDEX_VERSION = 1
+GRAM = 3
+
+TERM_RE = re.compile(r"[a-z0-9]+")
+HAN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+
+
+def normalize(text):
+    """Lowercase text with accents removed (café -> cafe)."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed
+                   if not unicodedata.combining(c)).lower()
+
+
+def terms(text):
+    return TERM_RE.findall(normalize(text))
+
+
+def trigrams(term):
+    return {term[i:i + GRAM] for i in range(len(term) - GRAM + 1)}
+
+
+def han_grams(text):
+    """Single Han characters and bigrams of adjacent ones in text."""
+    grams = set()
+    for run in HAN_RE.findall(text or ""):
+        grams.update(run)
+        grams.update(run[i:i + 2] for i in range(len(run) - 1))
+    return grams
+
+
+def build_index(catalog):
+    """Return the index dict for a loaded catalog (header filled by dump)."""
+    products = []
+    categories = []
+    product_category = []
+    postings = {}
+    zh = {}
+    for c, category in enumerate(catalog['categories']):
+        categories.append(category['name'])
+        category_terms = set(terms(category['name']))
+        for prod in category['products']:
+            p = len(products)
+            products.append(prod['id'])
+            product_category.append(c)
+            for term in category_terms | set(terms(prod['name'])):
+                postings.setdefault(term, []).append(p)
+            for gram in han_grams(prod.get('nameZh')):
+                zh.setdefault(gram, []).append(p)
+
+    sorted_terms = sorted(postings)
+    grams = {}
+    for t, term in enumerate(sorted_terms):
+        for gram in trigrams(term):
+            grams.setdefault(gram, []).append(t)
+
+    return {
+        "header": {},
+        "products": products,
+        "categories": categories,
+        "productCategory": product_category,
+        "terms": sorted_terms,
+        "postings": [postings[term] for term in sorted_terms],
+        "grams": dict(sorted(grams.items())),
+        "zh": dict(sorted(zh.items())),
+    }
+
+
+def dump(index, catalog_digest):
+    """
+    Serialize the index compactly with its header. The header holds the
+    file's own byte size, so it is sized with a placeholder first; the
+    final number can only be as long or one digit longer.
+    """
+    index["header"] = {
+        "version": INDEX_VERSION,
+        "catalog": catalog_digest,
+        "products": len(index["products"]),
+        "terms": len(index["terms"]),
+        "bytes": 0,
+    }
+    size = len(json.dumps(index, ensure_ascii=False,
+                          separators=(",", ":")).encode())
+    while True:
+        index["header"]["bytes"] = size
+        text = json.dumps(index, ensure_ascii=False, separators=(",", ":"))
+        if len(text.encode()) == size:
+            return text
+        size = len(text.encode())
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build the CatalogSearch index from catalog.json.")
+    parser.add_argument("--catalog", default=CATALOG_PATH, metavar="PATH",
+                        help=f"catalog to index (default {CATALOG_PATH})")
+    parser.add_argument("--out", default=INDEX_PATH, metavar="PATH",
+                        help=f"where to write the index (default {INDEX_PATH})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.catalog, 'rb') as f:
+        raw = f.read()
+    catalog = json.loads(raw)
+
+    index = build_index(catalog)
+    text = dump(index, hashlib.sha256(raw).hexdigest())
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    tmp = args.out + ".tmp"
+    with open(tmp, 'w', encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, args.out)
+
+    header = index["header"]
+    print(f"Indexed {header['products']} products: {header['terms']} terms, "
+          f"{len(index['grams'])} trigrams, {len(index['zh'])} Chinese grams "
+          f"-> {args.out} ({header['bytes'] / 1024:.1f} KB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,92 @@
 #!/usr/bin/env python3
 """
 Crop individual product images from Panda Depot catalog page images.
-Each page image is 1241 x 1754 pixels.
+Crop geometry is in units of a 1241 x 1754 reference page (IMG_W x IMG_H)
+and scaled to each page's real size, so higher-DPI scans (page-NN.png or
+page-NN.jpg) need no manual downscaling; see load_page.
 Products are cropped and saved as: {product_id}_{slugified_name}.png
+
+Runs are incremental: OUTPUT_DIR/.crop-manifest.json records a hash of the
+inputs of every output (page bytes, crop box, filename, encoder options), so
+unchanged crops are skipped without decoding their page and outputs that no
+config entry produces any more are pruned. Use --force to rebuild everything.
+The manifest is local build state and ignored by git; without one (a fresh
+clone) the first run crops everything once.
+With --watch the script stays running, keeps decoded pages in memory and
+re-runs whenever a page image, the catalog or PAGE_CONFIGS changes.
+
+On CI the run can be split across N runners with --shard i/N (pages are
+balanced by estimated cost); gather their OUTPUT_DIRs into one and run
+--merge to write the manifest and the full report.
+
+Commands: crop (the default, so plain options still work), page N... to
+crop only some pages, report for catalog coverage and output status, and
+list for the configured products. Pillow and NumPy are only loaded once
+pixels are needed, and the catalog index is kept compiled in
+CATALOG_CACHE_DIR, so report and list start in tens of milliseconds:
+
+    python crop_products.py --jobs 0
+    python crop_products.py page 12 14
+    python crop_products.py report
+
+As a library, iter_product_crops yields (product_id, slug, image or bytes)
+in memory for one page or the whole catalog, without writing anything:
+
+    for prod_id, slug, data in iter_product_crops([4, 5], encode="webp"):
+        upload(f"{prod_id}_{slug}.webp", data)
 """
+import argparse
+import ast
+import base64
+import collections
+import csv
+import hashlib
+import importlib
+import io
 import json
+import marshal
 import os
+import queue
 import re
-from PIL import Image
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+
+class LazyModule:
+    """
+    Stand-in for the module name under the global alias: the first
+    attribute access imports it (under a lock, as pipeline threads may race
+    for it) and puts the real module in place of the stand-in. Commands
+    that never touch pixels so start without NumPy and Pillow.
+    """
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        with self._lock:
+            module = importlib.import_module(self._name)
+            globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+np = LazyModule("numpy", "np")
+Image = LazyModule("PIL.Image", "Image")
+features = LazyModule("PIL.features", "features")
 
 IMAGES_DIR = "src/assets/images"
 CATALOG_PATH = "src/data/catalog.json"
 OUTPUT_DIR = "src/assets/products"
 
+# Reference page size: the units of every coordinate in PAGE_CONFIGS
 IMG_W, IMG_H = 1241, 1754
+PAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+PAGE_RE = re.compile(r"page-(\d+)(%s)$" % "|".join(
+    re.escape(ext) for ext in PAGE_EXTENSIONS))
 
 
 def slugify(name):
@@ -24,10 +97,10 @@ def slugify(name):
     return s[:60]  # keep filenames reasonable
 
 
-def crop_grid(img, content_area, rows, cols, cell_index,
-              photo_ratio=0.65, padding=5):
+def grid_box(content_area, rows, cols, cell_index,
+             photo_ratio=0.65, padding=5):
     """
-    Crop a specific cell from a grid layout.
+    Pixel box (x1, y1, x2, y2) of a cell in a grid layout.
     content_area: (top, left, bottom, right) of the product grid region
     cell_index: 0-based, reading order (left to right, top to bottom)
     photo_ratio: how much of the cell height is the photo (vs text below)
@@ -53,24 +126,322 @@ def crop_grid(img, content_area, rows, cols, cell_index,
     x2 = min(IMG_W, x2)
     y2 = min(IMG_H, y2)
 
-    return img.crop((x1, y1, x2, y2))
+    return (x1, y1, x2, y2)
 
 
-def crop_region(img, region, padding=3):
-    """Crop a specific (top, left, bottom, right) region."""
+def region_box(region, padding=3):
+    """Pixel box (x1, y1, x2, y2) of a (top, left, bottom, right) region."""
     t, l, b, r = region
-    return img.crop((
+    return (
         max(0, l + padding),
         max(0, t + padding),
         min(IMG_W, r - padding),
         min(IMG_H, b - padding)
-    ))
+    )
+
+
+def crop_grid(img, content_area, rows, cols, cell_index,
+              photo_ratio=0.65, padding=5):
+    """Crop a specific cell from a grid layout (see grid_box)."""
+    return img.crop(grid_box(content_area, rows, cols, cell_index,
+                             photo_ratio=photo_ratio, padding=padding))
+
+
+def crop_region(img, region, padding=3):
+    """Crop a specific (top, left, bottom, right) region."""
+    return img.crop(region_box(region, padding=padding))
+
+
+def page_boxes(config, grid_padding=5, region_padding=3, clip=True):
+    """
+    Every crop box of a page config in one vectorized step.
+    Returns (product_ids, boxes): the IDs in config order (None for empty
+    grid cells) and an (N, 4) int array of (x1, y1, x2, y2) rows, equal to
+    what grid_box/region_box return one at a time. clip=False leaves the
+    boxes unclamped to the page, for validation.
+    """
+    if config["mode"] == "manual":
+        ids = [entry[0] for entry in config["crops"]]
+        regions = np.array([entry[1:] for entry in config["crops"]],
+                           dtype=np.int64).reshape(-1, 4)
+        t, l, b, r = regions.T
+        boxes = np.stack([l + region_padding, t + region_padding,
+                          r - region_padding, b - region_padding], axis=1)
+        return ids, clip_boxes(boxes) if clip else boxes
+
+    top, left, bottom, right = config["content_area"]
+    rows = config["rows"]
+    cols = config["cols"]
+    ids = list(config["products"])
+    photo_ratio = config.get("photo_ratio", 0.60)
+    cell_w = (right - left) / cols
+    cell_h = (bottom - top) / rows
+
+    idx = np.arange(len(ids))
+    col = idx % cols
+    row = idx // cols
+
+    # Same float expressions as grid_box, so truncation gives the same ints
+    x1 = (left + col * cell_w + grid_padding).astype(np.int64)
+    y1 = (top + row * cell_h + grid_padding).astype(np.int64)
+    x2 = (left + (col + 1) * cell_w - grid_padding).astype(np.int64)
+    y2 = (top + row * cell_h + cell_h * photo_ratio).astype(np.int64)
+
+    boxes = np.stack([x1, y1, x2, y2], axis=1)
+    return ids, clip_boxes(boxes) if clip else boxes
+
+
+def clip_boxes(boxes):
+    """Clamp (N, 4) boxes to the page, as grid_box and region_box do."""
+    return np.stack([
+        np.maximum(0, boxes[:, 0]),
+        np.maximum(0, boxes[:, 1]),
+        np.minimum(IMG_W, boxes[:, 2]),
+        np.minimum(IMG_H, boxes[:, 3]),
+    ], axis=1)
+
+
+# Page modes whose decoded arrays round-trip through Image.fromarray.
+BATCH_MODES = ("L", "LA", "P", "RGB", "RGBA")
+# ... and need nothing but the array (a palette would have to be decoded)
+RAW_MODES = ("L", "LA", "RGB", "RGBA")
+# Decoded pages kept by --raw-cache, keyed by page content
+RAW_CACHE_DIR = ".cache/crop-pages"
+
+
+def crop_views(pixels, boxes):
+    """
+    Slice (x1, y1, x2, y2) boxes out of a decoded page array.
+    The slices are views into pixels, so nothing is copied until they are
+    encoded. Boxes must lie inside the page (Image.crop would pad instead).
+    """
+    return [pixels[y1:y2, x1:x2]
+            for x1, y1, x2, y2 in np.asarray(boxes).reshape(-1, 4).tolist()]
+
+
+def view_to_image(view, page):
+    """Wrap a crop view as an image with the page's mode, palette and info."""
+    if view.shape[0] == 0 or view.shape[1] == 0:
+        raise ValueError(f"empty crop {view.shape[1]}x{view.shape[0]}")
+    cropped = Image.fromarray(view)
+    if page.mode == "P":
+        cropped.putpalette(page.getpalette())
+    cropped.info = page.info.copy()
+    return cropped
+
+
+TRIM_TOLERANCE = 16
+TRIM_MARGIN = 6
+
+
+def trim_boxes(img, boxes, tolerance=TRIM_TOLERANCE, margin=TRIM_MARGIN):
+    """
+    Shrink (x1, y1, x2, y2) boxes to the content inside them.
+    The page is thresholded once into a content mask (pixels more than
+    tolerance grey levels below white), and prefix sums of that mask along
+    each axis give every box's occupied rows and columns without slicing
+    the pixels. margin pixels of background are kept around the content;
+    a box with no content is returned unchanged.
+    """
+    content = np.asarray(img.convert("L")) < 255 - tolerance
+    h, w = content.shape
+    row_sums = np.zeros((h, w + 1), dtype=np.int32)
+    row_sums[:, 1:] = content.cumsum(axis=1)
+    col_sums = np.zeros((h + 1, w), dtype=np.int32)
+    col_sums[1:] = content.cumsum(axis=0)
+
+    trimmed = []
+    for x1, y1, x2, y2 in boxes:
+        cx1, cx2 = min(x1, w), min(x2, w)
+        cy1, cy2 = min(y1, h), min(y2, h)
+        rows = np.flatnonzero(row_sums[cy1:cy2, cx2] - row_sums[cy1:cy2, cx1])
+        cols = np.flatnonzero(col_sums[cy2, cx1:cx2] - col_sums[cy1, cx1:cx2])
+        if not len(rows):
+            trimmed.append((x1, y1, x2, y2))
+            continue
+        trimmed.append((
+            max(x1, cx1 + int(cols[0]) - margin),
+            max(y1, cy1 + int(rows[0]) - margin),
+            min(x2, cx1 + int(cols[-1]) + 1 + margin),
+            min(y2, cy1 + int(rows[-1]) + 1 + margin),
+        ))
+    return trimmed
+
+
+# ── Automatic region detection ("auto" mode) ──
+# Pages are analysed at 1/AUTO_SCALE resolution. A pixel is foreground if it
+# is darker than AUTO_THRESHOLD; photos are where the foreground density in a
+# small window exceeds AUTO_DENSITY. Caption and price text is dense enough to
+# pass that test, so the mask is then opened (eroded and dilated again over
+# an AUTO_OPENING window): glyphs and text lines are thinner than the window
+# and vanish, photos only lose their ragged edges.
+
+AUTO_SCALE = 4
+AUTO_THRESHOLD = 225
+AUTO_DENSITY = 0.5
+AUTO_WINDOW = 1         # density window radius, in downsampled pixels
+AUTO_OPENING = 2        # opening window radius, in downsampled pixels
+AUTO_MIN_SIZE = 60      # smallest photo side, in page pixels
+AUTO_MAX_ASPECT = 5.0   # wider/taller components are treated as text lines
+AUTO_MARGIN = 8         # page pixels added around each detected photo
+
+
+def window_mean(a, radius):
+    """Mean of a 2-D array over a (2r+1)^2 window, via an integral image."""
+    h, w = a.shape
+    ii = np.zeros((h + 1, w + 1))
+    ii[1:, 1:] = a.cumsum(0).cumsum(1)
+    y0 = np.clip(np.arange(h) - radius, 0, h)
+    y1 = np.clip(np.arange(h) + radius + 1, 0, h)
+    x0 = np.clip(np.arange(w) - radius, 0, w)
+    x1 = np.clip(np.arange(w) + radius + 1, 0, w)
+    total = ii[y1][:, x1] - ii[y0][:, x1] - ii[y1][:, x0] + ii[y0][:, x0]
+    return total / ((y1 - y0)[:, None] * (x1 - x0)[None, :])
+
+
+def label_components(mask):
+    """
+    4-connected component labelling of a boolean mask.
+    Labels are propagated as whole-array neighbour minima with pointer
+    jumping, so the loop runs a few dozen times rather than once per pixel.
+    Returns (labels, count) with 0 for background and 1..count otherwise.
+    """
+    h, w = mask.shape
+    background = h * w + 1
+    labels = np.where(mask, np.arange(1, h * w + 1).reshape(h, w), background)
+    while True:
+        m = labels.copy()
+        np.minimum(m[1:], labels[:-1], out=m[1:])
+        np.minimum(m[:-1], labels[1:], out=m[:-1])
+        np.minimum(m[:, 1:], labels[:, :-1], out=m[:, 1:])
+        np.minimum(m[:, :-1], labels[:, 1:], out=m[:, :-1])
+        m = np.where(mask, m, background)
+        # Each label is the flat index + 1 of a pixel; follow that pixel's
+        # label to shortcut long chains.
+        flat = m.ravel()
+        fg = flat < background
+        for _ in range(4):
+            flat[fg] = flat[flat[fg] - 1]
+        if np.array_equal(m, labels):
+            break
+        labels = m
+
+    out = np.zeros((h, w), dtype=np.int64)
+    roots, inverse = np.unique(labels[mask], return_inverse=True)
+    out[mask] = inverse + 1
+    return out, len(roots)
+
+
+def reading_order(regions):
+    """
+    Indices of (top, left, bottom, right) regions in reading order.
+    Rows are the runs of the vertical projection profile of the regions;
+    within a row, regions go left to right.
+    """
+    regions = np.asarray(regions).reshape(-1, 4)
+    if not len(regions):
+        return np.zeros(0, dtype=np.int64)
+    tops, bottoms = regions[:, 0], regions[:, 2]
+    profile = np.zeros(int(bottoms.max()) + 2, dtype=np.int64)
+    np.add.at(profile, tops, 1)
+    np.add.at(profile, bottoms, -1)
+    covered = np.cumsum(profile) > 0
+    starts = covered & ~np.concatenate(([False], covered[:-1]))
+    row = np.cumsum(starts)[tops]
+    return np.lexsort((regions[:, 1], row))
+
+
+def detect_regions(img, content_area=None, threshold=AUTO_THRESHOLD,
+                   min_size=AUTO_MIN_SIZE):
+    """
+    Find product photo regions on a page image.
+    content_area: optional (top, left, bottom, right) to search within.
+    Returns an (N, 4) int array of (top, left, bottom, right) page-pixel
+    regions in reading order.
+    """
+    gray = np.asarray(img.convert("L").reduce(AUTO_SCALE))
+    density = window_mean(gray < threshold, AUTO_WINDOW)
+    mask = density > AUTO_DENSITY
+    solid = window_mean(mask, AUTO_OPENING) > 0.999
+    mask = window_mean(solid, AUTO_OPENING) > 0
+    if content_area is not None:
+        top, left, bottom, right = (int(v) // AUTO_SCALE for v in content_area)
+        area = np.zeros_like(mask)
+        area[top:bottom, left:right] = True
+        mask &= area
+
+    labels, count = label_components(mask)
+    ys, xs = np.nonzero(labels)
+    comp = labels[ys, xs] - 1
+    big = np.iinfo(np.int64).max
+    t = np.full(count, big)
+    l = np.full(count, big)
+    b = np.full(count, -1)
+    r = np.full(count, -1)
+    np.minimum.at(t, comp, ys)
+    np.minimum.at(l, comp, xs)
+    np.maximum.at(b, comp, ys)
+    np.maximum.at(r, comp, xs)
+
+    regions = np.stack([t, l, b + 1, r + 1], axis=1) * AUTO_SCALE
+    h = regions[:, 2] - regions[:, 0]
+    w = regions[:, 3] - regions[:, 1]
+    keep = ((h >= min_size) & (w >= min_size)
+            & (w <= h * AUTO_MAX_ASPECT) & (h <= w * AUTO_MAX_ASPECT))
+    regions = regions[keep]
+
+    page_h, page_w = img.height, img.width
+    regions = np.stack([
+        np.maximum(0, regions[:, 0] - AUTO_MARGIN),
+        np.maximum(0, regions[:, 1] - AUTO_MARGIN),
+        np.minimum(page_h, regions[:, 2] + AUTO_MARGIN),
+        np.minimum(page_w, regions[:, 3] + AUTO_MARGIN),
+    ], axis=1)
+    return regions[reading_order(regions)]
+
+
+def match_regions(product_ids, regions):
+    """
+    Pair an ordered product ID list with detected regions.
+    If there are more regions than products the largest ones are used,
+    still in reading order. Returns (pairs, unmatched_regions), where pairs
+    is [(prod_id, region or None)] in product order.
+    """
+    regions = np.asarray(regions).reshape(-1, 4)
+    n = len(product_ids)
+    unmatched = []
+    if len(regions) > n:
+        area = ((regions[:, 2] - regions[:, 0])
+                * (regions[:, 3] - regions[:, 1]))
+        keep = np.zeros(len(regions), dtype=bool)
+        keep[np.argsort(-area, kind="stable")[:n]] = True
+        unmatched = [tuple(r) for r in regions[~keep].tolist()]
+        regions = regions[keep]
+    found = [tuple(r) for r in regions.tolist()]
+    pairs = [(pid, found[i] if i < len(found) else None)
+             for i, pid in enumerate(product_ids)]
+    return pairs, unmatched
+
+
+def region_mismatch(pairs, unmatched):
+    """
+    Why a match_regions result cannot be trusted, or None. Pairing is only
+    by reading order, so unless every product got a region and every
+    region a product, the boxes may belong to other products.
+    """
+    found = sum(region is not None for _, region in pairs)
+    if found == len(pairs) and not unmatched:
+        return None
+    return (f"{found + len(unmatched)} regions detected for {len(pairs)} "
+            "products")
 
 
 # ── Page layout configurations ──
 # Each page config maps product IDs to their crop locations.
 # "grid" mode: (content_area, rows, cols, product_list_in_order, photo_ratio)
 # "manual" mode: list of (product_id, top, left, bottom, right)
+# "auto" mode: products in reading order, plus an optional content_area and
+#   threshold; regions come from detect_regions (review them with --detect)
 
 PAGE_CONFIGS = {
     # ──── Page 2: Thai Jasmine Rice (1 product, photo at bottom center) ────
@@ -519,103 +890,2973 @@ PAGE_CONFIGS = {
 }
 
 
-def main():
-    # Load catalog for product name lookup
-    with open(CATALOG_PATH, 'r') as f:
-        catalog = json.load(f)
+# Options passed to Image.save for every crop. They are part of each
+# manifest key, so changing them invalidates every cached output.
+PNG_SAVE_OPTIONS = {"format": "PNG"}
 
-    # Build product ID -> name mapping
+# Responsive variants (--variants): each crop is also written at these
+# widths in these formats, into OUTPUT_DIR/VARIANTS_SUBDIR, and listed in
+# VARIANTS_JSON_PATH for building srcset attributes.
+VARIANT_WIDTHS = (160, 320, 640)
+VARIANT_FORMATS = ("avif", "webp")
+VARIANT_SAVE_OPTIONS = {
+    "avif": {"format": "AVIF", "quality": 60, "speed": 8},
+    "webp": {"format": "WEBP", "quality": 80, "method": 4},
+    "png": {"format": "PNG", "optimize": True},
+}
+VARIANTS_SUBDIR = "variants"
+VARIANTS_JSON_PATH = "src/data/product-images.json"
+
+# Size-optimizing encoder (--optimize): candidate encodings tried for every
+# crop (see ENCODERS), the perceptual error (1 - SSIM, in the worst colour
+# channel) a lossy one may add and the block size the error is measured
+# over. At 0.025 the palette-64 crops that win on the catalog have a 99th
+# percentile channel error of about 15/255 (23/255 for the worst tenth).
+OPTIMIZE_ENCODERS = ("png-opt", "palette-256", "palette-64")
+OPTIMIZE_MAX_ERROR = 0.025
+SSIM_BLOCK = 8
+
+# Near-duplicate crops (--dedupe): DCT hash bits that may differ. Sizes of
+# one product line (soup-011/012) are only 4 apart, so this stays below
+# that: a shared asset must be the same photo.
+DEDUPE_THRESHOLD = 3
+DEDUPE_JSON_PATH = "src/data/product-dedupe.json"
+
+# Blurred placeholders and colors (--placeholders), inlined by the pages
+# while the full image loads
+PLACEHOLDER_SIZE = 16           # longest side of the placeholder grid
+PLACEHOLDER_JSON_PATH = "src/data/product-placeholders.json"
+
+# Per-category sprite sheets of product thumbnails (--atlas)
+ATLAS_SUBDIR = "atlas"
+ATLAS_THUMB = 160               # longest side of a thumbnail
+ATLAS_MAX_SIZE = (1024, 2048)   # a category spills onto more sheets past this
+ATLAS_PADDING = 2               # gap between sprites, against filtering bleed
+
+# Crop QA (--qa): crops are compared as QA_SIZE x QA_SIZE grey thumbnails;
+# a metric past its QA_LIMITS entry flags the crop
+QA_SIZE = 128
+QA_BORDER = 2                   # thumbnail pixels checked for clipping
+QA_TOP = 24                     # crops shown on the contact sheet
+QA_LIMITS = {
+    "background": 0.9,          # share of near-white pixels
+    "text": 0.04,               # share of thin dark strokes (captions)
+    "clipped": 0.85,            # content along the most crowded edge
+    "neighbour": 0.9,           # correlation with a crop next to it
+}
+
+# The manifest and the --shard partial results sit in OUTPUT_DIR, as they
+# describe (and travel with) the files there: gathering shard OUTPUT_DIRs
+# gathers their partials. They are local build state, so git ignores them.
+MANIFEST_NAME = ".crop-manifest.json"
+MANIFEST_VERSION = 1
+
+
+def page_path(page_num, images_dir=None):
+    """The page's image, page-NN.png unless only a JPEG of it exists."""
+    stem = os.path.join(images_dir or IMAGES_DIR, f"page-{page_num:02d}")
+    for ext in PAGE_EXTENSIONS:
+        if os.path.exists(stem + ext):
+            return stem + ext
+    return stem + PAGE_EXTENSIONS[0]
+
+
+def product_filename(prod_id, id_to_name):
+    """Output filename for a product: {product_id}_{slugified_name}.png"""
+    name = id_to_name.get(prod_id, prod_id)
+    return f"{prod_id}_{slugify(name)}.png"
+
+
+def iter_catalog(path, chunk_size=1 << 16):
+    """Yield (product_id, name) for every product in catalog.json."""
+    for category in iter_categories(path, chunk_size):
+        for prod in category['products']:
+            yield prod['id'], prod['name']
+
+
+def iter_categories(path, chunk_size=1 << 16):
+    """
+    Yield the category objects of catalog.json without loading the whole
+    file: it is read chunk_size characters at a time and only one category
+    is decoded at once, so memory stays flat however many SKUs the catalog
+    holds. Malformed files raise json.JSONDecodeError as json.load would,
+    positioned in the whole file.
+    """
+    decoder = json.JSONDecoder()
+    blank = re.compile(r"[ \t\n\r]*")
+    with open(path, 'r', encoding="utf-8") as f:
+        buf, pos, eof = "", 0, False
+        # Characters and newlines dropped from the front of buf so far, and
+        # where the line that buf starts in began, for error positions.
+        offset, lines, line_start = 0, 0, 0
+
+        def fill():
+            # Read at least as much again as is buffered, so a value spanning
+            # many chunks is re-scanned a logarithmic number of times.
+            nonlocal buf, pos, eof, offset, lines, line_start
+            chunk = f.read(max(chunk_size, len(buf) - pos))
+            eof = not chunk
+            newlines = buf.count("\n", 0, pos)
+            if newlines:
+                lines += newlines
+                line_start = offset + buf.rindex("\n", 0, pos) + 1
+            offset += pos
+            buf, pos = buf[pos:] + chunk, 0
+
+        def error(msg, at):
+            # A JSONDecodeError at buf[at], positioned in the whole file
+            e = json.JSONDecodeError(msg, buf, at)
+            e.pos = offset + at
+            if "\n" in buf[:at]:
+                e.lineno += lines
+            else:
+                e.lineno, e.colno = lines + 1, e.pos - line_start + 1
+            e.args = (f"{msg}: line {e.lineno} column {e.colno} "
+                      f"(char {e.pos})",)
+            return e
+
+        def peek():
+            nonlocal pos
+            while True:
+                pos = blank.match(buf, pos).end()
+                if pos < len(buf) or eof:
+                    return buf[pos:pos + 1]
+                fill()
+
+        def take(chars):
+            nonlocal pos
+            char = peek()
+            if not char or char not in chars:
+                raise error(f"Expecting one of {chars!r}", pos)
+            pos += 1
+            return char
+
+        def value():
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError as e:
+                    if eof:
+                        raise error(e.msg, e.pos) from None
+                else:
+                    # A number at the end of the buffer may go on in the
+                    # next chunk.
+                    if end < len(buf) or eof:
+                        pos = end
+                        return obj
+                fill()
+
+        def elements(close):
+            # Step through a container whose opening bracket was just taken.
+            nonlocal pos
+            if peek() == close:
+                pos += 1
+                return
+            while True:
+                yield
+                if take("," + close) == close:
+                    return
+
+        take("{")
+        for _ in elements("}"):
+            if peek() != '"':
+                raise error("Expecting property name enclosed in double "
+                            "quotes", pos)
+            key = value()
+            take(":")
+            if key != "categories":
+                value()
+                continue
+            take("[")
+            for _ in elements("]"):
+                yield value()
+        if peek():
+            raise error("Extra data", pos)
+
+
+CATALOG_CACHE_DIR = ".cache"
+CATALOG_CACHE_VERSION = 1
+
+
+def catalog_index(path=None):
+    """
+    [(product_id, name, category name)] of every catalog product, in
+    catalog order, from a compiled (marshal) copy in CATALOG_CACHE_DIR. The
+    copy is used while the catalog's (mtime, size) match, or failing that
+    its sha256 (as after a fresh checkout); otherwise the catalog is parsed
+    again (iter_categories) and the copy rewritten.
+    """
+    path = os.path.abspath(path or CATALOG_PATH)
+    cache_path = os.path.join(
+        CATALOG_CACHE_DIR,
+        f"catalog-{hashlib.sha256(path.encode()).hexdigest()[:16]}.bin")
+    stamp = file_stamp(path)
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = marshal.load(f)
+        if cache["version"] != CATALOG_CACHE_VERSION:
+            cache = None
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        cache = None
+    if cache and cache["stamp"] == stamp:
+        return cache["products"]
+
+    digest = file_digest(path)
+    if not cache or cache["sha256"] != digest:
+        cache = {"version": CATALOG_CACHE_VERSION, "sha256": digest,
+                 "products": [(prod['id'], prod['name'], category['name'])
+                              for category in iter_categories(path)
+                              for prod in category['products']]}
+    cache["stamp"] = stamp
+    try:
+        os.makedirs(CATALOG_CACHE_DIR, exist_ok=True)
+        tmp = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            marshal.dump(cache, f)
+        os.replace(tmp, cache_path)
+    except OSError:
+        pass  # a read-only tree just parses the catalog every time
+    return cache["products"]
+
+
+def catalog_names(configs):
+    """
+    Split the catalog index into (id_to_name, missing): names of the
+    products the configs crop, and of every other catalog product for the
+    coverage report.
+    """
+    cropped_ids = configured_ids(configs)
     id_to_name = {}
-    for cat in catalog['categories']:
-        for prod in cat['products']:
-            id_to_name[prod['id']] = prod['name']
+    missing = {}
+    for prod_id, name, _ in catalog_index(CATALOG_PATH):
+        if prod_id in cropped_ids:
+            id_to_name[prod_id] = name
+        else:
+            missing[prod_id] = name
+    return id_to_name, missing
+
+
+def configured_ids(configs):
+    """Every product ID that some page config crops."""
+    ids = set()
+    for config in configs.values():
+        if config["mode"] == "manual":
+            ids.update(entry[0] for entry in config["crops"] if entry[0])
+        elif config["mode"] in ("grid", "auto"):
+            ids.update(pid for pid in config["products"] if pid)
+    return ids
+
+
+def auto_regions(page_num, config, detected=None, images_dir=None):
+    """
+    Detected regions of an "auto" page, paired with its products as
+    match_regions does. detected caches regions across runs per page,
+    keyed by the page bytes and the detection settings, so an unchanged
+    page is not decoded just to find its boxes again.
+    """
+    path = page_path(page_num, images_dir)
+    if not os.path.exists(path):
+        return [(pid, None) for pid in config["products"]], []
+
+    key = detect_key(page_num, config, images_dir)
+    entry = (detected or {}).get(str(page_num))
+    if entry and entry["key"] == key:
+        regions = entry["regions"]
+    else:
+        with reference_page(path) as img:
+            regions = detect_regions(
+                img, config.get("content_area"),
+                config.get("threshold", AUTO_THRESHOLD)).tolist()
+        if detected is not None:
+            detected[str(page_num)] = {"key": key, "regions": regions}
+    return match_regions(config["products"], regions)
+
+
+def detect_key(page_num, config, images_dir=None):
+    """Key of an auto page's regions: its bytes and the detection settings."""
+    payload = json.dumps([file_digest(page_path(page_num, images_dir)),
+                          config.get("content_area"),
+                          config.get("threshold", AUTO_THRESHOLD),
+                          AUTO_SCALE, AUTO_DENSITY, AUTO_WINDOW, AUTO_OPENING,
+                          AUTO_MIN_SIZE, AUTO_MAX_ASPECT, AUTO_MARGIN])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def page_tasks(page_num, config, id_to_name, detected=None, images_dir=None):
+    """
+    Resolve a page config into crop tasks without touching any pixels
+    (except for "auto" pages whose regions are not in detected yet).
+    Returns a list of (prod_id, label, filename, box) in config order; box
+    is None for an auto product that no region was found for, and for
+    every product of an auto page whose regions do not pair up one to one
+    with its products (see region_mismatch).
+    """
+    if config["mode"] == "auto":
+        pairs, unmatched = auto_regions(page_num, config, detected,
+                                        images_dir)
+        ids = [pid for pid, _ in pairs]
+        if region_mismatch(pairs, unmatched):
+            boxes = [None] * len(pairs)
+        else:
+            boxes = [region_box(region) for _, region in pairs]
+    else:
+        ids, boxes = page_boxes(config)
+        boxes = [tuple(box) for box in boxes.tolist()]
+
+    tasks = []
+    for idx, (prod_id, box) in enumerate(zip(ids, boxes)):
+        if prod_id is None:
+            continue
+        if config["mode"] == "manual":
+            label = f"p{page_num:02d}"
+        else:
+            label = f"p{page_num:02d} [{idx}]"
+        tasks.append((prod_id, label, product_filename(prod_id, id_to_name),
+                      box))
+    return tasks
+
+
+# Compiled plan kept by --plan, with the other caches (not in OUTPUT_DIR,
+# which the site bundles)
+PLAN_PATH = ".cache/crop-plan.npz"
+PLAN_VERSION = 1
+PLAN_COLUMNS = ("page", "slot", "mode", "product", "raw", "box", "filename")
+
+
+def compile_plan(configs, id_to_name):
+    """
+    Flatten page configs into a crop plan without touching any pixels: a
+    dict of equal-length NumPy columns with one row per crop, in page and
+    config order. "slot" is the product's index in its page config, "box"
+    the (x1, y1, x2, y2) rectangle that gets cropped and "raw" the same box
+    before it is clamped to the page. Both are -1 on "auto" pages, whose
+    boxes are only known once the page has been detected.
+    """
+    pages, slots, modes, products, raws = [], [], [], [], []
+    for page_num, config in sorted(configs.items()):
+        if config["mode"] == "auto":
+            ids = list(config["products"])
+            raw = np.full((len(ids), 4), -1, dtype=np.int64)
+        else:
+            ids, raw = page_boxes(config, clip=False)
+        keep = [i for i, prod_id in enumerate(ids) if prod_id is not None]
+        pages += [page_num] * len(keep)
+        slots += keep
+        modes += [config["mode"]] * len(keep)
+        products += [ids[i] for i in keep]
+        raws.append(raw[keep])
+
+    raw = np.concatenate(raws) if raws else np.empty((0, 4), dtype=np.int64)
+    mode = np.array(modes, dtype=str)
+    auto = (mode == "auto")[:, None]
+    return {
+        "page": np.array(pages, dtype=np.int64),
+        "slot": np.array(slots, dtype=np.int64),
+        "mode": mode,
+        "product": np.array(products, dtype=str),
+        "raw": raw,
+        "box": np.where(auto, -1, clip_boxes(raw)),
+        "filename": np.array([product_filename(prod_id, id_to_name)
+                              for prod_id in products], dtype=str),
+    }
+
+
+def plan_label(plan, i):
+    """The log label of plan row i, as page_tasks makes it."""
+    if plan["mode"][i] == "manual":
+        return f"p{plan['page'][i]:02d}"
+    return f"p{plan['page'][i]:02d} [{plan['slot'][i]}]"
+
+
+def validate_plan(plan, configs, catalog_ids=None):
+    """
+    Check a compiled plan with vectorized passes over its columns.
+    Returns a list of (level, page, message) sorted by page, level being
+    "error" for boxes that are empty or reach off the page, product IDs
+    used more than once and grids whose products do not fill rows * cols,
+    or "warning" for overlapping boxes on a page and products missing from
+    the catalog (given as catalog_ids).
+    """
+    issues = []
+    product, raw, box = plan["product"], plan["raw"], plan["box"]
+    page = plan["page"].tolist()
+    fixed = plan["mode"] != "auto"
+
+    def name(i):
+        return f"{plan_label(plan, i)} {product[i]}"
+
+    outside = fixed & ((raw[:, 0] < 0) | (raw[:, 1] < 0)
+                       | (raw[:, 2] > IMG_W) | (raw[:, 3] > IMG_H))
+    for i in np.flatnonzero(outside):
+        issues.append(("error", page[i], f"{name(i)}: box {tuple(raw[i].tolist())} "
+                       f"reaches off the {IMG_W}x{IMG_H} page"))
+    empty = fixed & ((box[:, 2] <= box[:, 0]) | (box[:, 3] <= box[:, 1]))
+    for i in np.flatnonzero(empty):
+        issues.append(("error", page[i], f"{name(i)}: box {tuple(box[i].tolist())} "
+                       f"is empty"))
+
+    # Every pair of boxes on the same page: rows are sorted by page, so
+    # row r pairs with the rows after it up to the end of its page.
+    rows = np.flatnonzero(fixed & ~empty)
+    end = np.searchsorted(plan["page"][rows], plan["page"][rows],
+                          side="right")
+    counts = end - np.arange(len(rows)) - 1
+    first = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+    a, b = rows[first], rows[first + 1 + offsets]
+    w = np.minimum(box[a, 2], box[b, 2]) - np.maximum(box[a, 0], box[b, 0])
+    h = np.minimum(box[a, 3], box[b, 3]) - np.maximum(box[a, 1], box[b, 1])
+    area = np.maximum(w, 0) * np.maximum(h, 0)
+    for k in np.flatnonzero(area):
+        issues.append(("warning", page[a[k]],
+                       f"{name(a[k])} and {name(b[k])} overlap by "
+                       f"{int(area[k])} px"))
+
+    ids, first_row, counts = np.unique(product, return_index=True,
+                                       return_counts=True)
+    for prod_id, i in zip(ids[counts > 1], first_row[counts > 1]):
+        where = ", ".join(plan_label(plan, j)
+                          for j in np.flatnonzero(product == prod_id))
+        issues.append(("error", page[i],
+                       f"{prod_id} is planned more than once: {where}"))
+
+    grids = [(page_num, config) for page_num, config in sorted(configs.items())
+             if config["mode"] == "grid"]
+    given = np.array([len(config["products"]) for _, config in grids])
+    cells = np.array([config["rows"] * config["cols"] for _, config in grids])
+    for k in np.flatnonzero(given != cells):
+        page_num, config = grids[k]
+        issues.append(("error", page_num,
+                       f"p{page_num:02d}: {given[k]} products for a "
+                       f"{config['rows']}x{config['cols']} grid"))
+
+    if catalog_ids is not None:
+        unknown = ~np.isin(product, np.array(sorted(catalog_ids), dtype=str))
+        for i in np.flatnonzero(unknown):
+            issues.append(("warning", page[i], f"{name(i)}: not in the "
+                           f"catalog, so its filename uses the ID"))
+
+    issues.sort(key=lambda issue: (issue[1], issue[0] != "error"))
+    return issues
+
+
+def plan_key(configs, id_to_name):
+    """Cache key of a compiled plan: everything compile_plan reads."""
+    payload = json.dumps([PLAN_VERSION, IMG_W, IMG_H, configs,
+                          sorted(id_to_name.items())], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def load_plan(path, key):
+    """The plan cached at path if it was compiled under key, else None."""
+    import zipfile
+
+    try:
+        with np.load(path) as data:
+            if str(data["key"]) != key:
+                return None
+            return {column: data[column] for column in PLAN_COLUMNS}
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def save_plan(path, plan, key):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        np.savez(f, key=np.array(key), **plan)
+    os.replace(tmp, path)
+
+
+def file_digest(path):
+    """sha256 of a file's bytes, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def output_settings(options):
+    """The run options that change output bytes (batch, for one, does not)."""
+    options = options or {}
+    variants = options.get("variants")
+    return {
+        "save": PNG_SAVE_OPTIONS,
+        "trim": options.get("trim"),
+        "variants": variants and {
+            "widths": list(variants["widths"]),
+            "formats": {fmt: VARIANT_SAVE_OPTIONS[fmt]
+                        for fmt in variants["formats"]},
+        },
+        # Only when set, so keys of runs without them stay valid
+        **{name: options[name] for name in ("optimize", "scale")
+           if options.get(name) not in (None, False, 1)},
+    }
+
+
+def crop_key(page_digest, box, filename, options=None):
+    """Manifest key for one output: a hash of everything its bytes depend on."""
+    payload = json.dumps([page_digest, list(box), filename,
+                          output_settings(options)], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def load_manifest(path):
+    """
+    Return the manifest of a previous run: "files" maps each output filename
+    to its entry and "detected" holds the auto_regions cache. Both are empty
+    if there is no usable manifest.
+    """
+    empty = {"files": {}, "detected": {}}
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return empty
+    if manifest.get("version") != MANIFEST_VERSION:
+        return empty
+    return {key: manifest.get(key, {}) for key in empty}
+
+
+def save_manifest(path, files, detected=None):
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump({"version": MANIFEST_VERSION, "files": files,
+                   "detected": detected or {}}, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def new_stats():
+    """Per-page profile: page-level stages plus per-product stages."""
+    return {"stages": {}, "products": {}}
+
+
+@contextmanager
+def measure(stages, stage):
+    """
+    Add the wall and CPU time of the block to stages[stage] and yield that
+    entry so the block can add the bytes it handled. CPU time is per thread,
+    so pipeline stages running side by side are not counted twice.
+    """
+    entry = stages.setdefault(
+        stage, {"calls": 0, "wall": 0.0, "cpu": 0.0, "bytes": 0})
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield entry
+    finally:
+        entry["calls"] += 1
+        entry["wall"] += time.perf_counter() - wall
+        entry["cpu"] += time.thread_time() - cpu
+
+
+def raster_bytes(img):
+    """Uncompressed size of an image in memory."""
+    return img.width * img.height * len(img.getbands())
+
+
+def load_page(path, scale=1):
+    """
+    Open and decode a page at about scale times the reference size, as an
+    image of at least that size and less than twice it (pages smaller than
+    that are decoded as they are). Large JPEG scans are decoded straight at
+    the reduced size (draft scales in the DCT domain), so their full raster
+    never exists; other formats are decoded in full once and box-reduced by
+    an integer factor before anything else sees them.
+    """
+    img = Image.open(path)
+    try:
+        target = (round(IMG_W * scale), round(IMG_H * scale))
+        if img.width >= 2 * target[0] and img.height >= 2 * target[1]:
+            img.draft(img.mode, target)
+        img.load()
+        factor = min(img.width // target[0], img.height // target[1])
+        if factor >= 2:
+            reduced = img.reduce(factor)
+            reduced.info = img.info.copy()
+            img.close()
+            img = reduced
+    except Exception:
+        img.close()
+        raise
+    return img
+
+
+def reference_page(path):
+    """A page decoded at the reference width, for region detection."""
+    img = load_page(path)
+    if img.width != IMG_W:
+        with img:
+            return img.resize(
+                (IMG_W, round(img.height * IMG_W / img.width)), Image.LANCZOS)
+    return img
+
+
+def raw_page(path, cache_dir, scale=1, digest=None):
+    """
+    The pixels of a page from the raw page cache in cache_dir: the array
+    load_page decodes, saved once as .npy under the sha256 of the page file
+    (digest, if already known) and the scale, and memory-mapped read-only.
+    Crops then read only the rows they cover, and processes cropping the
+    same page share it through the OS page cache. Returns None for pages
+    in modes an array cannot hold alone (see RAW_MODES). Arrays of pages
+    that changed stay behind; delete cache_dir to reclaim the space.
+    """
+    with Image.open(path) as img:
+        if img.mode not in RAW_MODES:
+            return None
+    name = os.path.join(cache_dir,
+                        f"{digest or file_digest(path)}-{scale:g}.npy")
+    try:
+        return np.load(name, mmap_mode="r")
+    except (FileNotFoundError, ValueError):
+        pass
+    with load_page(path, scale) as img:
+        pixels = np.asarray(img)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written aside and renamed, as other processes may be mapping it
+    tmp = f"{name}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        np.save(f, pixels)
+    os.replace(tmp, name)
+    return np.load(name, mmap_mode="r")
+
+
+def open_page(path, options=None, digest=None):
+    """
+    (img, pixels) of a page for iter_crops. Usually img is the page decoded
+    by load_page and pixels None; with options["raw_cache"] (a directory)
+    pixels are mapped from the raw page cache (see raw_page, which is
+    handed digest) and img is the page opened but not decoded, for its
+    mode and info.
+    """
+    options = options or {}
+    if options.get("raw_cache"):
+        pixels = raw_page(path, options["raw_cache"], options.get("scale", 1),
+                          digest)
+        if pixels is not None:
+            return Image.open(path), pixels
+    return load_page(path, options.get("scale", 1)), None
+
+
+def file_stamp(path):
+    """(mtime, size) of a file, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def new_page_cache(limit):
+    """
+    Decoded pages and page digests kept between runs by --watch, keyed by
+    path and checked against the file stamp. Pages are evicted least
+    recently used first once their raster size adds up to more than limit
+    bytes.
+    """
+    return {"limit": limit, "bytes": 0, "pages": collections.OrderedDict(),
+            "digests": {}}
+
+
+def cached_digest(path, page_cache=None):
+    """file_digest of path, remembered in page_cache while its stamp holds."""
+    if page_cache is None:
+        return file_digest(path)
+    stamp = file_stamp(path)
+    entry = page_cache["digests"].get(path)
+    if entry is None or entry[0] != stamp:
+        entry = page_cache["digests"][path] = (stamp, file_digest(path))
+    return entry[1]
+
+
+@contextmanager
+def page_image(page_num, stats, page_cache=None, options=None,
+               images_dir=None, digest=None):
+    """
+    (img, pixels) of a page (see open_page, which is handed digest), with
+    the decode timed into stats. Without a page_cache the image is closed
+    when the block ends; with one it is decoded in full and stays open in
+    the cache for the next run. images_dir defaults to IMAGES_DIR.
+    """
+    path = page_path(page_num, images_dir)
+    if page_cache is None:
+        with measure(stats["stages"], "decode") as m:
+            img, pixels = open_page(path, options, digest)
+            m["bytes"] += raster_bytes(img) if pixels is None else pixels.nbytes
+        with img:
+            yield img, pixels
+        return
+
+    pages = page_cache["pages"]
+    stamp = file_stamp(path)
+    entry = pages.get(path)
+    if entry is None or entry[0] != stamp:
+        if entry is not None:
+            del pages[path]
+            page_cache["bytes"] -= raster_bytes(entry[1])
+            entry[1].close()
+        with measure(stats["stages"], "decode") as m:
+            img = load_page(path, (options or {}).get("scale", 1))
+            m["bytes"] += raster_bytes(img)
+        entry = pages[path] = (stamp, img)
+        page_cache["bytes"] += raster_bytes(img)
+        while page_cache["bytes"] > page_cache["limit"] and len(pages) > 1:
+            _, (_, old) = pages.popitem(last=False)
+            page_cache["bytes"] -= raster_bytes(old)
+            old.close()
+    pages.move_to_end(path)
+    yield entry[1], None
+
+
+def pages_in_flight(max_memory, page_nums):
+    """
+    How many decoded pages fit in max_memory bytes. Each page is counted at
+    twice the raster size of the largest one, leaving room for its crops on
+    their way to the encoder; sizes come from the image headers, so nothing
+    is decoded.
+    """
+    largest = 0
+    for page_num in page_nums:
+        with Image.open(page_path(page_num)) as img:
+            largest = max(largest, raster_bytes(img))
+    return max(1, max_memory // (2 * largest)) if largest else 1
+
+
+def split_cached(page_num, tasks, cached, options=None, stats=None,
+                 page_cache=None, images_dir=None, output_dir=None):
+    """
+    Split a page's tasks into outputs that are still up to date and work
+    (cached as in crop_page). Returns (results, todo, page_digest): results
+    has a ("skip", ...) tuple for every cached output and a None slot for
+    every item of todo, which holds (slot, prod_id, label, filename, box,
+    key), and page_digest is the page's file_digest, for open_page.
+    images_dir and output_dir default to IMAGES_DIR and OUTPUT_DIR.
+    """
+    stats = stats or new_stats()
+    path = page_path(page_num, images_dir)
+    with measure(stats["stages"], "hash") as m:
+        page_digest = cached_digest(path, page_cache)
+        m["bytes"] += os.path.getsize(path)
+    results = []
+    todo = []
+
+    for prod_id, label, filename, box in tasks:
+        if box is None:
+            results.append(("fail", prod_id, label, filename, None,
+                            "no matching region detected", None))
+            continue
+        key = crop_key(page_digest, box, filename, options)
+        old_key, stored = cached.get(filename, (None, None))
+        if (old_key == key
+                and os.path.exists(os.path.join(output_dir or OUTPUT_DIR,
+                                                stored))):
+            results.append(("skip", prod_id, label, filename, key, None, None))
+        else:
+            results.append(None)
+            todo.append((len(results) - 1, prod_id, label, filename, box, key))
+    return results, todo, page_digest
+
+
+def fail_todo(results, todo, error):
+    """Mark every item of todo (see split_cached) failed with error."""
+    for i, prod_id, label, filename, box, key in todo:
+        results[i] = ("fail", prod_id, label, filename, key, str(error), None)
+
+
+def iter_crops(img, boxes, options=None, stats=None, pixels=None):
+    """
+    Iterator over the crop of img for each box, or the exception raised
+    making it.
+    pixels, if given, is the decoded array of img (see open_page), which is
+    cropped instead; img then only supplies the mode and info.
+    Boxes are in reference page units (IMG_W x IMG_H) and scaled to img by
+    its width over IMG_W (scans keep their aspect; a stray row or column is
+    no reason to resample). Each crop comes out at options["scale"]
+    (default 1) times its box size, resampled if the page was decoded at
+    another resolution.
+    options["trim"] = (tolerance, margin) shrinks the boxes first (see
+    trim_boxes). With options["batch"], the page is decoded once into an
+    array and every crop stays a view of it until it is wrapped for
+    encoding (see crop_views). That page-level work is done (and timed into
+    stats) by this call, not by the first next(), so it is not counted as
+    the first product's crop.
+    """
+    options = options or {}
+    scale = options.get("scale", 1)
+    height, width = (img.height, img.width) if pixels is None else pixels.shape[:2]
+    page_scale = width / IMG_W
+    if page_scale != 1:
+        boxes = np.rint(np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+                        * page_scale).astype(np.int64)
+        boxes = np.minimum(boxes, [width, height] * 2)
+    try:
+        crops = _iter_crops(img, boxes, options, stats, pixels)
+    except Exception as e:
+        return iter([e] * len(boxes))
+    if page_scale == scale:
+        return crops
+    return _resize_crops(crops, scale / page_scale)
+
+
+def _resize_crops(crops, factor):
+    for cropped in crops:
+        if not isinstance(cropped, Exception) and cropped.width and cropped.height:
+            try:
+                size = (max(1, round(cropped.width * factor)),
+                        max(1, round(cropped.height * factor)))
+                resized = cropped.resize(size, Image.LANCZOS)
+                resized.info = cropped.info
+                cropped = resized
+            except Exception as e:
+                cropped = e
+        yield cropped
+
+
+def _iter_crops(img, boxes, options, stats, pixels=None):
+    stages = (stats or new_stats())["stages"]
+    if options.get("trim"):
+        with measure(stages, "trim"):
+            boxes = trim_boxes(img if pixels is None
+                               else Image.fromarray(pixels), boxes,
+                               *options["trim"])
+    if pixels is None and options.get("batch") and img.mode in BATCH_MODES:
+        with measure(stages, "array") as m:
+            pixels = np.asarray(img)
+            m["bytes"] += pixels.nbytes
+    if pixels is not None:
+        return _wrap_views(crop_views(pixels, boxes), img)
+    return _crop_boxes(img, boxes)
+
+
+def _wrap_views(views, img):
+    for view in views:
+        try:
+            yield view_to_image(view, img)
+        except Exception as e:
+            yield e
+
+
+def _crop_boxes(img, boxes):
+    for box in boxes:
+        try:
+            yield img.crop(box)
+        except Exception as e:
+            yield e
+
+
+def supported_formats(formats):
+    """The variant formats this Pillow build can write; PNG if none of them."""
+    usable = []
+    for fmt in formats:
+        try:
+            if fmt == "png" or features.check_module(fmt):
+                usable.append(fmt)
+        except ValueError:  # Pillow too old to know the module at all
+            pass
+    return usable or ["png"]
+
+
+def variant_name(filename, width, fmt):
+    stem = os.path.splitext(filename)[0]
+    return f"{VARIANTS_SUBDIR}/{stem}-{width}w.{fmt}"
+
+
+def encode_outputs(cropped, filename, options=None, stages=None):
+    """
+    Encode a crop into every file it produces.
+    Returns (files, info): files is [(name relative to OUTPUT_DIR, bytes)],
+    the full-size PNG first; info is recorded in the manifest entry.
+    With options["variants"], the crop is encoded at its own width and at
+    every smaller requested width. The smaller sizes are built as a pyramid,
+    largest first, each level resampled from the one above it rather than
+    from the full crop. Time and encoded bytes are added to stages["encode"].
+    """
+    with measure({} if stages is None else stages, "encode") as m:
+        files, info = _encode_outputs(cropped, filename, options)
+        m["bytes"] += sum(len(data) for _, data in files)
+    return files, info
+
+
+def _encode_outputs(cropped, filename, options):
+    info = {"width": cropped.width, "height": cropped.height}
+    if (options or {}).get("optimize"):
+        data, choice = optimize_png(cropped, **options["optimize"])
+        info.update(choice)
+    else:
+        buf = io.BytesIO()
+        cropped.save(buf, **PNG_SAVE_OPTIONS)
+        data = buf.getvalue()
+    files = [(filename, data)]
+    if (options or {}).get("placeholders"):
+        info.update(placeholder_info(cropped))
+
+    variants = (options or {}).get("variants")
+    if not variants:
+        return files, info
+
+    level = cropped
+    if level.mode not in ("RGB", "RGBA", "L", "LA"):
+        level = level.convert("RGBA" if "transparency" in level.info else "RGB")
+    info["variants"] = []
+    widths = {w for w in variants["widths"] if w < level.width}
+    for width in sorted(widths | {level.width}, reverse=True):
+        height = max(1, round(level.height * width / level.width))
+        if width != level.width:
+            level = level.resize((width, height), Image.LANCZOS)
+        for fmt in variants["formats"]:
+            buf = io.BytesIO()
+            level.save(buf, **VARIANT_SAVE_OPTIONS[fmt])
+            name = variant_name(filename, width, fmt)
+            files.append((name, buf.getvalue()))
+            info["variants"].append({"file": name, "format": fmt,
+                                     "width": width, "height": height})
+    return files, info
+
+
+def _png_bytes(img, **save):
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", **save)
+    return buf.getvalue()
+
+
+def _palette_encoder(colors):
+    def encode(img):
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        quantized = img.quantize(colors, method=Image.Quantize.FASTOCTREE,
+                                 dither=Image.Dither.NONE)
+        return _png_bytes(quantized, optimize=True), quantized.convert(img.mode)
+    return encode
+
+
+# Candidate encodings for --optimize: name -> encode(img) returning
+# (PNG bytes, the image they decode to, or None if lossless). Every
+# candidate writes PNG, as the pages link the .png outputs; WebP and AVIF
+# come from --variants.
+ENCODERS = {
+    "png-opt": lambda img: (_png_bytes(img, optimize=True), None),
+    "palette-256": _palette_encoder(256),
+    "palette-128": _palette_encoder(128),
+    "palette-64": _palette_encoder(64),
+    "palette-32": _palette_encoder(32),
+}
+
+_encoder_pool = None
+
+
+def encoder_pool():
+    """Threads shared by optimize_png calls in this process (Pillow releases
+    the GIL while quantizing and compressing)."""
+    global _encoder_pool
+    if _encoder_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _encoder_pool = ThreadPoolExecutor(
+            max_workers=len(ENCODERS) + 1, thread_name_prefix="encode")
+    return _encoder_pool
+
+
+def ssim_error(a, b, block=SSIM_BLOCK):
+    """
+    1 - mean SSIM of two same-size images over non-overlapping
+    block x block windows, in the worst of their R, G, B (and alpha)
+    channels: 0 for identical images, growing as structure, contrast,
+    brightness or colour drift apart. Grey levels alone miss the hue shifts
+    of a small palette.
+    """
+    alpha = a.mode in ("RGBA", "LA") or "transparency" in a.info
+    mode = "RGBA" if alpha else "RGB"
+    x = np.asarray(a.convert(mode), dtype=np.uint64)
+    y = np.asarray(b.convert(mode), dtype=np.uint64)
+    n = x.shape[2]
+    rows = max(1, x.shape[0] // block)
+    cols = max(1, x.shape[1] // block)
+    m = block_means(np.concatenate([x, y, x * x, y * y, x * y], axis=2),
+                    rows, cols)[0]
+    mx, my = m[..., :n], m[..., n:2 * n]
+    vx, vy = m[..., 2 * n:3 * n] - mx * mx, m[..., 3 * n:4 * n] - my * my
+    cov = m[..., 4 * n:] - mx * my
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    ssim = ((2 * mx * my + c1) * (2 * cov + c2)
+            / ((mx * mx + my * my + c1) * (vx + vy + c2)))
+    return float(1 - ssim.mean(axis=(0, 1)).min())
+
+
+def optimize_png(img, encoders=OPTIMIZE_ENCODERS, max_error=OPTIMIZE_MAX_ERROR,
+                 budget=None):
+    """
+    Encode a crop with the default PNG settings and every named candidate
+    of ENCODERS at once, and pick one. Lossy candidates must stay within
+    max_error (see ssim_error). With a byte budget the least lossy
+    candidate that fits it wins, otherwise (or if none fits) the smallest.
+    Returns (bytes, info) with the chosen encoder, its bytes and error and
+    the bytes of the default encoding for the savings report.
+    """
+    def run(name):
+        if name == "png":
+            return name, _png_bytes(img, **{k: v for k, v in
+                                            PNG_SAVE_OPTIONS.items()
+                                            if k != "format"}), 0.0
+        data, decoded = ENCODERS[name](img)
+        return name, data, 0.0 if decoded is None else ssim_error(img, decoded)
+
+    pool = encoder_pool()
+    candidates = list(pool.map(run, ["png", *encoders]))
+    baseline = len(candidates[0][1])
+    ok = [c for c in candidates if c[2] <= max_error]
+    fits = [c for c in ok if budget and len(c[1]) <= budget]
+    if fits:
+        name, data, error = min(fits, key=lambda c: (c[2], len(c[1])))
+    else:
+        name, data, error = min(ok, key=lambda c: len(c[1]))
+    return data, {"encoder": name, "bytes": len(data),
+                  "png_bytes": baseline, "error": round(error, 5),
+                  **({"over_budget": True} if budget and len(data) > budget
+                     else {})}
+
+
+def print_savings(files):
+    """Bytes --optimize saved per encoder and in total, over files."""
+    entries = [e for e in files.values() if "encoder" in e]
+    if not entries:
+        return
+    before = sum(e["png_bytes"] for e in entries)
+    after = sum(e["bytes"] for e in entries)
+    counts = collections.Counter(e["encoder"] for e in entries)
+    over = sum(1 for e in entries if e.get("over_budget"))
+    print(f"Encoder: {after / 1024:.0f} KB instead of {before / 1024:.0f} KB "
+          f"as plain PNG, saved {(before - after) / 1024:.0f} KB "
+          f"({1 - after / max(1, before):.0%}) over {len(entries)} crops; "
+          + ", ".join(f"{n} {name}" for name, n in counts.most_common())
+          + (f"; {over} over the byte budget" if over else ""))
+
+
+def write_outputs(files, stages=None, output_dir=None):
+    with measure({} if stages is None else stages, "write") as m:
+        for name, data in files:
+            path = os.path.join(output_dir or OUTPUT_DIR, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            m["bytes"] += len(data)
+
+
+def entry_variants(entry):
+    """Variant files (relative to OUTPUT_DIR) recorded in a manifest entry."""
+    return [v["file"] for v in entry.get("variants", [])]
+
+
+def stored_file(filename, entry):
+    """
+    The output holding a manifest entry's pixels: its own file, or the
+    shared asset --dedupe stored it as (see write_dedupe).
+    """
+    return entry.get("asset", filename)
+
+
+def write_variants_json(path, files):
+    """
+    Write the srcset manifest: for each product, its full-size PNG and the
+    variant files grouped by format, smallest first, e.g.
+    {"products": {"deli-001": {"src": ..., "width": ..., "height": ...,
+                               "sources": {"webp": [{"file", "width",
+                                                      "height"}, ...]}}}}
+    File paths are relative to OUTPUT_DIR; products stored as a shared
+    asset (--dedupe) list that asset's files.
+    """
+    products = {}
+    for filename, entry in sorted(files.items()):
+        src = stored_file(filename, entry)
+        stored = files.get(src, entry)
+        sources = {}
+        for v in sorted(stored.get("variants", []), key=lambda v: v["width"]):
+            sources.setdefault(v["format"], []).append(
+                {"file": v["file"], "width": v["width"], "height": v["height"]})
+        products[entry["product"]] = {
+            "src": src,
+            "width": stored.get("width"),
+            "height": stored.get("height"),
+            "sources": sources,
+        }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({"version": 1, "products": products}, f, indent=2,
+                  ensure_ascii=False)
+        f.write("\n")
+
+
+def block_means(pixels, rows, cols):
+    """
+    Mean of each cell of an (H, W, C) array cut into a rows x cols grid of
+    near-equal cells, as float64, with two reduceat passes. Returns the
+    (rows, cols, C) means and the (rows, cols) pixel counts of the cells.
+    """
+    h, w = pixels.shape[:2]
+    ys = np.linspace(0, h, rows + 1).astype(int)
+    xs = np.linspace(0, w, cols + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(
+        pixels, ys[:-1], axis=0, dtype=np.uint64), xs[:-1], axis=1)
+    counts = np.diff(ys)[:, None] * np.diff(xs)[None, :]
+    return sums / counts[..., None], counts
+
+
+def hex_color(rgb):
+    return "#" + "".join(f"{int(round(c)):02x}" for c in rgb)
+
+
+def placeholder_info(img, size=PLACEHOLDER_SIZE):
+    """
+    Placeholder fields of a crop's manifest entry, from the image already in
+    memory: "placeholder", a data URI of the crop averaged down to at most
+    size x size pixels (the page scales it up blurred), "color", its mean
+    color, and "dominant", the mean of the most common color bin (3 bits
+    per channel) with near-white page background left out.
+    """
+    rgb = img if img.mode == "RGB" else img.convert("RGB")
+    pixels = np.asarray(rgb)
+    scale = size / max(img.width, img.height)
+    rows = min(img.height, max(1, round(img.height * scale)))
+    cols = min(img.width, max(1, round(img.width * scale)))
+    cells, counts = block_means(pixels, rows, cols)
+
+    flat = cells.reshape(-1, 3)
+    weight = counts.reshape(-1)
+    mean = (flat * weight[:, None]).sum(axis=0) / weight.sum()
+    keep = flat.min(axis=1) < 235
+    if not keep.any():
+        keep[:] = True
+    bins = (flat.astype(np.uint8) >> 5).astype(np.int64) @ [64, 8, 1]
+    votes = np.bincount(bins[keep], weights=weight[keep], minlength=512)
+    top = keep & (bins == votes.argmax())
+    dominant = (flat[top] * weight[top, None]).sum(axis=0) / weight[top].sum()
+
+    buf = io.BytesIO()
+    Image.fromarray(np.round(cells).astype(np.uint8)).save(
+        buf, format="PNG", optimize=True)
+    return {
+        "placeholder": "data:image/png;base64,"
+                       + base64.b64encode(buf.getvalue()).decode("ascii"),
+        "color": hex_color(mean),
+        "dominant": hex_color(dominant),
+    }
+
+
+def write_placeholders(path, files):
+    """
+    Write the placeholder sidecar, keyed by product ID:
+    {"products": {"deli-001": {"placeholder": "data:image/png;base64,...",
+                               "color": "#rrggbb", "dominant": "#rrggbb",
+                               "width": ..., "height": ...}}}
+    Fields are computed while cropping; outputs cropped before placeholders
+    were asked for are read back once and their entries in files filled in.
+    Products stored as a shared asset (--dedupe) get that asset's fields.
+    """
+    products = {}
+    filled = 0
+    for filename, entry in sorted(files.items()):
+        src = stored_file(filename, entry)
+        stored = files.get(src, entry)
+        if "placeholder" not in stored:
+            out_file = os.path.join(OUTPUT_DIR, src)
+            if not os.path.exists(out_file):
+                continue
+            with Image.open(out_file) as img:
+                stored.update(placeholder_info(img))
+            filled += 1
+        products[entry["product"]] = {
+            k: stored.get(k) for k in ("placeholder", "color", "dominant",
+                                       "width", "height")}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({"version": 1, "size": PLACEHOLDER_SIZE,
+                   "products": products}, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    note = f", {filled} read back from earlier crops" if filled else ""
+    print(f"Placeholders: {len(products)} product(s){note} -> {path}")
+
+
+def dct_matrix(n):
+    """Orthonormal DCT-II basis: dct_matrix(n) @ x transforms columns of x."""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    m[0] /= np.sqrt(2)
+    return m
+
+
+def perceptual_hashes(images, size=32, bits=8):
+    """
+    DCT hashes of a list of images, computed for all of them at once:
+    each is shrunk to size x size grey, transformed, and the lowest
+    bits x bits frequencies are compared with their median (the DC term
+    left out). Returns an (N, bits * bits) bool array.
+    """
+    stack = np.stack([
+        np.asarray(img.convert("L").resize((size, size), Image.LANCZOS),
+                   dtype=np.float64)
+        for img in images])
+    d = dct_matrix(size)
+    low = (d @ stack @ d.T)[:, :bits, :bits].reshape(len(images), -1)
+    return low > np.median(low[:, 1:], axis=1, keepdims=True)
+
+
+def near_duplicates(hashes, threshold, block=256):
+    """
+    Group the rows of an (N, B) bool hash array that lie within threshold
+    differing bits of each other, chaining transitively. Hamming distances
+    are taken as matrix products a block of rows at a time, so memory stays
+    at block * N. Returns a list of index groups with more than one member.
+    """
+    n = len(hashes)
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    h = hashes.astype(np.float32)
+    ones = h.sum(axis=1)
+    for start in range(0, n, block):
+        rows = h[start:start + block]
+        dist = ones[start:start + block, None] + ones[None, :] - 2 * rows @ h.T
+        for i, j in zip(*np.nonzero(dist <= threshold)):
+            i += start
+            if i < j:
+                parent[find(i)] = find(j)
+
+    groups = {}
+    for i in range(n):
+        groups.setdefault(find(i), []).append(i)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def write_dedupe(path, files, threshold=DEDUPE_THRESHOLD):
+    """
+    Find near-duplicate crops, store each group once and write the
+    shared-asset map to path:
+    {"assets": {product_id: file}, "groups": [{"asset": file, "samePage",
+     "products": [{"id", "file", "page", "distance"}]}]}
+    Each group's asset is its largest crop on disk. The other members'
+    files and variants are deleted and their entries in files point at it
+    ("asset", see stored_file), so later runs skip them while it exists and
+    --variants, --placeholders and --atlas list it for them. Products
+    outside any group are left out of the map. Hashes are kept in the
+    entries ("phash", hex), so only new crops are read and members stored
+    as an asset are still compared; one that no longer matches its group
+    is dropped from files and cropped again by the next run. Groups with
+    two products on one page are reported ("samePage") but not shared: they
+    are usually look-alike products or a box that caught a neighbouring
+    photo.
+    """
+    names = sorted(fn for fn, entry in files.items()
+                   if "asset" in entry
+                   or os.path.exists(os.path.join(OUTPUT_DIR, fn)))
+    if not names:
+        print("Dedupe: no outputs to compare")
+        return
+    todo = [fn for fn in names if "phash" not in files[fn]]
+    for start in range(0, len(todo), 256):
+        images = []
+        for fn in todo[start:start + 256]:
+            with Image.open(os.path.join(OUTPUT_DIR, fn)) as img:
+                img.load()
+                images.append(img)
+        for fn, bits in zip(todo[start:start + 256],
+                            perceptual_hashes(images)):
+            files[fn]["phash"] = np.packbits(bits).tobytes().hex()
+    hashes = np.unpackbits(np.array(
+        [np.frombuffer(bytes.fromhex(files[fn]["phash"]), dtype=np.uint8)
+         for fn in names]).reshape(len(names), -1), axis=1).astype(bool)
+
+    assets = {}
+    shared = {}     # member file -> the asset it is stored as
+    groups = []
+    for group in near_duplicates(hashes, threshold):
+        # Largest first, of the crops that still have their own file
+        group.sort(key=lambda i: ("asset" in files[names[i]],
+                                  -files[names[i]].get("width", 0)
+                                  * files[names[i]].get("height", 0),
+                                  names[i]))
+        if "asset" in files[names[group[0]]]:
+            continue
+        asset = names[group[0]]
+        members = [{"id": files[names[i]]["product"], "file": names[i],
+                    "page": files[names[i]]["page"],
+                    "distance": int((hashes[i] != hashes[group[0]]).sum())}
+                   for i in group]
+        pages = [m["page"] for m in members]
+        same_page = len(set(pages)) < len(pages)
+        if not same_page:
+            for m in members:
+                assets[m["id"]] = asset
+            shared.update((m["file"], asset) for m in members[1:])
+        groups.append({"asset": asset, "samePage": same_page,
+                       "products": members})
+        note = " (same page, not shared: check the boxes)" * same_page
+        print(f"  [DUP] {asset} <- " + ", ".join(
+            f"{m['id']} p{m['page']:02d} d={m['distance']}"
+            for m in members[1:]) + note)
+
+    removed = 0
+    for fn in names:
+        entry = files[fn]
+        if fn in shared:
+            if "asset" not in entry:
+                for name in [fn, *entry_variants(entry)]:
+                    out_file = os.path.join(OUTPUT_DIR, name)
+                    if os.path.exists(out_file):
+                        os.remove(out_file)
+                        removed += 1
+                entry.pop("variants", None)
+            entry["asset"] = shared[fn]
+        elif "asset" in entry:
+            del files[fn]
+            print(f"  [DUP] {fn} no longer matches {entry['asset']}: "
+                  f"cropped again on the next run")
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({"version": 1, "threshold": threshold,
+                   "assets": dict(sorted(assets.items())),
+                   "groups": groups}, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+    print(f"Dedupe: {len(groups)} group(s), {len(shared)} duplicate crop(s) "
+          f"stored as a shared asset ({removed} file(s) removed) -> {path}")
+
+
+def pack_shelves(sizes, max_width, max_height, padding=ATLAS_PADDING):
+    """
+    Pack (width, height) rectangles into rows ("shelves") on sheets of at
+    most max_width x max_height, tallest first: next-fit decreasing height.
+    Returns (places, sheets): places[i] is (sheet, x, y) for sizes[i] and
+    sheets the (width, height) each sheet actually uses.
+    """
+    places = [None] * len(sizes)
+    sheets = []
+    x = y = shelf = 0
+    for i in sorted(range(len(sizes)),
+                    key=lambda i: (-sizes[i][1], -sizes[i][0])):
+        w, h = sizes[i]
+        if sheets and x + w > max_width:
+            x, y, shelf = 0, y + shelf + padding, 0
+        if not sheets or y + h > max_height:
+            sheets.append((0, 0))
+            x = y = shelf = 0
+        places[i] = (len(sheets) - 1, x, y)
+        width, height = sheets[-1]
+        sheets[-1] = (max(width, x + w), max(height, y + h))
+        x += w + padding
+        shelf = max(shelf, h)
+    return places, sheets
+
+
+def qa_metrics(stack, tolerance=TRIM_TOLERANCE):
+    """
+    Metrics of an (N, S, S) uint8 stack of grey crop thumbnails, for all of
+    them at once. Returns a dict of (N,) arrays:
+    background  share of pixels within tolerance of white
+    edges       share of pixels with a strong gradient
+    text        share of pixels on thin dark strokes: dark pixels with both
+                a light pixel within one step and one two steps the other
+                way, as in caption lettering (photos have wider dark areas)
+    ("clipped" needs the full-size crop, see clipped_share.)
+    """
+    g = stack.astype(np.float32) / 255
+    light = g > 1 - tolerance / 255
+    gx = np.abs(np.diff(g, axis=2))[:, :-1, :]
+    gy = np.abs(np.diff(g, axis=1))[:, :, :-1]
+    edges = np.hypot(gx, gy) > 0.25
+
+    dark = g < 0.45
+    bright = g > 0.75
+    stroke = np.zeros_like(dark)
+    for axis in (1, 2):
+        before = np.roll(bright, 1, axis=axis) | np.roll(bright, 2, axis=axis)
+        after = np.roll(bright, -1, axis=axis) | np.roll(bright, -2, axis=axis)
+        stroke |= dark & before & after
+
+    return {
+        "background": light.mean(axis=(1, 2)),
+        "edges": edges.mean(axis=(1, 2)),
+        "text": stroke.mean(axis=(1, 2)),
+    }
+
+
+def clipped_share(gray, box_size=None, trim_margin=None,
+                  tolerance=TRIM_TOLERANCE):
+    """
+    Share of content pixels along the most crowded border band of a grey
+    crop (2D uint8 array), high when a box cuts through a product. The band
+    is what QA_BORDER thumbnail pixels cover, and shares are of the
+    (width, height) of the box the crop was cut from (box_size, default
+    the crop's own). A crop trimmed with trim_margin pixels has content
+    that close to its edges by design, so its band stays inside the margin
+    (nothing can be told without one); measuring against the untrimmed box
+    keeps the shares those of the untrimmed crop.
+    """
+    h, w = gray.shape
+    box_w, box_h = box_size or (w, h)
+    rows = max(1, round(box_h * QA_BORDER / QA_SIZE))
+    cols = max(1, round(box_w * QA_BORDER / QA_SIZE))
+    if trim_margin is not None:
+        rows = min(rows, trim_margin // 2)
+        cols = min(cols, trim_margin // 2)
+        if not rows or not cols:
+            return 0.0
+    content = gray < 255 - tolerance
+    return float(max(content[:rows].sum() / (rows * box_w),
+                     content[-rows:].sum() / (rows * box_w),
+                     content[:, :cols].sum() / (cols * box_h),
+                     content[:, -cols:].sum() / (cols * box_h)))
+
+
+def neighbour_similarity(stack, groups):
+    """
+    Highest correlation of each thumbnail in stack with the one before or
+    after it in its group (lists of stack indices, e.g. a page's crops in
+    config order). Near 1 means two boxes caught the same picture.
+    """
+    g = stack.reshape(len(stack), -1).astype(np.float32)
+    g -= g.mean(axis=1, keepdims=True)
+    g /= np.maximum(np.linalg.norm(g, axis=1, keepdims=True), 1e-6)
+    best = np.zeros(len(stack), dtype=np.float32)
+    for group in groups:
+        idx = np.asarray(group)
+        if len(idx) < 2:
+            continue
+        sim = (g[idx[:-1]] * g[idx[1:]]).sum(axis=1)
+        best[idx[:-1]] = np.maximum(best[idx[:-1]], sim)
+        best[idx[1:]] = np.maximum(best[idx[1:]], sim)
+    return best
+
+
+def write_qa(path, files, top=QA_TOP, trim_margin=None, scale=1):
+    """
+    Score every crop in files (the manifest's "files" map) for the usual
+    signs of a bad box and write a JSON report to path, ranked most
+    suspicious first, plus a contact sheet of the top crops next to it
+    (.png). Each metric (see qa_metrics, neighbour_similarity) is flagged
+    past its QA_LIMITS entry; the score adds how far every metric sits
+    above the catalog median, in units of its median absolute deviation,
+    so crops unlike the rest rank first even below the limits.
+    trim_margin and scale are the --trim margin (if any) and --scale the
+    crops were made with.
+    """
+    order = compile_plan(PAGE_CONFIGS, {})
+    slots = {prod_id: (page, slot) for page, slot, prod_id in zip(
+        order["page"].tolist(), order["slot"].tolist(),
+        order["product"].tolist())}
+    # Untrimmed output size of every product with a fixed box
+    box_sizes = {prod_id: (round((x2 - x1) * scale), round((y2 - y1) * scale))
+                 for prod_id, mode, (x1, y1, x2, y2) in zip(
+                     order["product"].tolist(), order["mode"].tolist(),
+                     order["box"].tolist()) if mode != "auto"}
+    if trim_margin is not None:
+        trim_margin = round(trim_margin * scale)
+    names = sorted(
+        (fn for fn in files if os.path.exists(os.path.join(OUTPUT_DIR, fn))),
+        key=lambda fn: (slots.get(files[fn]["product"], (1 << 30, 0)), fn))
+    if not names:
+        return
+    stack = np.empty((len(names), QA_SIZE, QA_SIZE), dtype=np.uint8)
+    clipped = np.empty(len(names))
+    for i, fn in enumerate(names):
+        with Image.open(os.path.join(OUTPUT_DIR, fn)) as img:
+            gray = img.convert("L")
+        box_size = box_sizes.get(files[fn]["product"]) if trim_margin else None
+        clipped[i] = clipped_share(np.asarray(gray), box_size, trim_margin)
+        stack[i] = np.asarray(gray.resize((QA_SIZE, QA_SIZE), Image.BOX))
+
+    metrics = qa_metrics(stack)
+    metrics["clipped"] = clipped
+    pages = {}
+    for i, fn in enumerate(names):
+        pages.setdefault(files[fn]["page"], []).append(i)
+    metrics["neighbour"] = neighbour_similarity(stack, pages.values())
+
+    score = np.zeros(len(names))
+    for name, values in metrics.items():
+        median = np.median(values)
+        spread = np.median(np.abs(values - median)) + 1e-3
+        score += np.maximum(0, (values - median) / spread)
+    flags = {name: metrics[name] > limit for name, limit in QA_LIMITS.items()}
+    score += 10 * sum(flags.values())
+
+    crops = []
+    for rank, i in enumerate(np.argsort(-score, kind="stable").tolist(), 1):
+        entry = files[names[i]]
+        crops.append({
+            "rank": rank, "product": entry["product"], "file": names[i],
+            "page": entry["page"], "score": round(float(score[i]), 2),
+            "flags": [name for name in QA_LIMITS if flags[name][i]],
+            "metrics": {name: round(float(values[i]), 4)
+                        for name, values in metrics.items()},
+        })
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({"version": 1, "limits": QA_LIMITS, "crops": crops}, f,
+                  indent=2)
+        f.write("\n")
+
+    sheet_path = os.path.splitext(path)[0] + ".png"
+    write_contact_sheet(sheet_path, crops[:top])
+    flagged = sum(1 for crop in crops if crop["flags"])
+    print(f"QA: {flagged} of {len(crops)} crop(s) flagged -> {path}, "
+          f"top {min(top, len(crops))} on {sheet_path}")
+    for crop in crops[:flagged]:
+        print(f"  [QA] {crop['product']} p{crop['page']:02d} "
+              f"score {crop['score']}: {', '.join(crop['flags'])}")
+
+
+def write_contact_sheet(path, crops, thumb=ATLAS_THUMB, cols=6):
+    """A grid of crop thumbnails, each captioned with rank, ID and flags."""
+    from PIL import ImageDraw
+
+    font_h = 12
+    cell_w, cell_h = thumb + 8, thumb + 8 + 2 * font_h
+    rows = max(1, -(-len(crops) // cols))
+    sheet = Image.new("RGB", (cell_w * min(cols, max(1, len(crops))),
+                              cell_h * rows), (255, 255, 255))
+    draw = ImageDraw.Draw(sheet)
+    for n, crop in enumerate(crops):
+        x, y = (n % cols) * cell_w + 4, (n // cols) * cell_h + 4
+        with Image.open(os.path.join(OUTPUT_DIR, crop["file"])) as img:
+            img = img.convert("RGB")
+        img.thumbnail((thumb, thumb), Image.LANCZOS)
+        sheet.paste(img, (x, y))
+        draw.rectangle((x - 1, y - 1, x + img.width, y + img.height),
+                       outline=(200, 0, 0) if crop["flags"] else (180, 180, 180))
+        draw.text((x, y + thumb + 2), f"#{crop['rank']} {crop['product']}",
+                  fill=(0, 0, 0))
+        draw.text((x, y + thumb + 2 + font_h), ",".join(crop["flags"]),
+                  fill=(200, 0, 0))
+    sheet.save(path, **PNG_SAVE_OPTIONS)
+
+
+def write_atlases(files, size=ATLAS_THUMB):
+    """
+    Pack thumbnails (longest side size) of the cropped products of each
+    catalog category into sprite sheets under OUTPUT_DIR/ATLAS_SUBDIR:
+    {category}-{n}.png plus {category}.json, which maps each product ID to
+    its sheet and rectangle for CSS background positioning, e.g.
+    {"sheets": [{"file", "width", "height"}],
+     "sprites": {"deli-001": {"sheet": 0, "x", "y", "width", "height"}}}
+    files is the manifest's "files" map; products stored as a shared asset
+    (--dedupe) are drawn from it. A category whose outputs have not changed
+    keeps its sheets, and atlas files of categories that are gone are
+    pruned.
+    """
+    by_product = {}
+    for filename, entry in files.items():
+        src = stored_file(filename, entry)
+        if src in files and os.path.exists(os.path.join(OUTPUT_DIR, src)):
+            by_product[entry["product"]] = (src, files[src]["key"])
+    atlas_dir = os.path.join(OUTPUT_DIR, ATLAS_SUBDIR)
+    os.makedirs(atlas_dir, exist_ok=True)
+    keep = set()
+
+    for category in iter_categories(CATALOG_PATH):
+        members = [(prod['id'], *by_product[prod['id']])
+                   for prod in category['products'] if prod['id'] in by_product]
+        if not members:
+            continue
+        slug = slugify(category['name'])
+        map_name = f"{slug}.json"
+        payload = json.dumps([size, ATLAS_MAX_SIZE, ATLAS_PADDING,
+                              PNG_SAVE_OPTIONS, members], sort_keys=True)
+        key = hashlib.sha256(payload.encode()).hexdigest()
+        try:
+            with open(os.path.join(atlas_dir, map_name), 'r') as f:
+                old = json.load(f)
+        except (OSError, ValueError):
+            old = {}
+        sheet_names = [sheet["file"] for sheet in old.get("sheets", [])]
+        if old.get("key") == key and all(
+                os.path.exists(os.path.join(OUTPUT_DIR, name))
+                for name in sheet_names):
+            keep.update([map_name, *(os.path.basename(n) for n in sheet_names)])
+            continue
+
+        thumbs = []
+        for _, filename, _ in members:
+            with Image.open(os.path.join(OUTPUT_DIR, filename)) as img:
+                alpha = img.mode in ("RGBA", "LA") or "transparency" in img.info
+                thumb = img.convert("RGBA" if alpha else "RGB")
+            thumb.thumbnail((size, size), Image.LANCZOS)
+            thumbs.append(thumb)
+        places, sizes = pack_shelves([t.size for t in thumbs], *ATLAS_MAX_SIZE)
+        mode = "RGBA" if any(t.mode == "RGBA" for t in thumbs) else "RGB"
+        background = (255, 255, 255, 0) if mode == "RGBA" else (255, 255, 255)
+        sheets = [Image.new(mode, sheet_size, background)
+                  for sheet_size in sizes]
+        sprites = {}
+        for (prod_id, _, _), thumb, (n, x, y) in zip(members, thumbs, places):
+            sheets[n].paste(thumb, (x, y))
+            sprites[prod_id] = {"sheet": n, "x": x, "y": y,
+                                "width": thumb.width, "height": thumb.height}
+
+        atlas = {"version": 1, "key": key, "category": category['name'],
+                 "sheets": [], "sprites": sprites}
+        for n, sheet in enumerate(sheets):
+            name = f"{slug}-{n}.png"
+            sheet.save(os.path.join(atlas_dir, name), **PNG_SAVE_OPTIONS)
+            atlas["sheets"].append({"file": f"{ATLAS_SUBDIR}/{name}",
+                                    "width": sheet.width,
+                                    "height": sheet.height})
+            keep.add(name)
+        with open(os.path.join(atlas_dir, map_name), 'w') as f:
+            json.dump(atlas, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        keep.add(map_name)
+        print(f"  [ATLAS] {ATLAS_SUBDIR}/{map_name}: {len(sprites)} sprites "
+              f"on {len(sheets)} sheet(s)")
+
+    for name in sorted(set(os.listdir(atlas_dir)) - keep):
+        os.remove(os.path.join(atlas_dir, name))
+        print(f"  [PRUNE] {ATLAS_SUBDIR}/{name}")
+
+
+def crop_page(page_num, tasks, cached=None, options=None, page_cache=None,
+              images_dir=None, output_dir=None):
+    """
+    Crop and save the given tasks (see page_tasks) from one page.
+    cached maps filename -> (manifest key, stored file) from the previous
+    run (see stored_file); outputs whose key still matches and whose stored
+    file still exists are skipped, and the page image is only opened if
+    something is left to crop.
+    Returns a list of (status, prod_id, label, filename, key, error, info)
+    in task order, with status "ok", "skip" or "fail" and info the manifest
+    details from encode_outputs for "ok". options are the settings of
+    iter_crops and encode_outputs. Runs in a worker process under --jobs,
+    so it must not print or touch shared state.
+    Returns (results, stats), stats being the page's profile (new_stats).
+    page_cache is passed on to split_cached and page_image. images_dir and
+    output_dir default to IMAGES_DIR and OUTPUT_DIR; run_pool passes them,
+    as a worker started by spawn sees the module defaults.
+    """
+    stats = new_stats()
+    results, todo, digest = split_cached(page_num, tasks, cached or {},
+                                         options, stats, page_cache,
+                                         images_dir, output_dir)
+    if not todo:
+        return results, stats
+
+    with ExitStack() as stack:
+        try:
+            img, pixels = stack.enter_context(
+                page_image(page_num, stats, page_cache, options, images_dir,
+                           digest))
+        except Exception as e:
+            # A page that cannot be decoded fails its products, not the run
+            fail_todo(results, todo, e)
+            return results, stats
+        crops = iter_crops(img, [t[4] for t in todo], options, stats, pixels)
+        for i, prod_id, label, filename, box, key in todo:
+            stages = stats["products"].setdefault(prod_id, {})
+            try:
+                with measure(stages, "crop") as m:
+                    cropped = next(crops)
+                    if isinstance(cropped, Exception):
+                        raise cropped
+                    m["bytes"] += raster_bytes(cropped)
+                files, info = encode_outputs(cropped, filename, options, stages)
+                write_outputs(files, stages, output_dir)
+                results[i] = ("ok", prod_id, label, filename, key, None, info)
+            except Exception as e:
+                results[i] = ("fail", prod_id, label, filename, key, str(e),
+                              None)
+
+    return results, stats
+
+
+def _format_encoder(fmt):
+    """encode(image) -> bytes of it as fmt ("png" or a VARIANT_SAVE_OPTIONS
+    format), for iter_product_crops."""
+    save_options = (PNG_SAVE_OPTIONS if fmt == "png"
+                    else VARIANT_SAVE_OPTIONS[fmt])
+
+    def encode(image):
+        if fmt != "png" and image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert(
+                "RGBA" if "transparency" in image.info else "RGB")
+        buf = io.BytesIO()
+        image.save(buf, **save_options)
+        return buf.getvalue()
+    return encode
+
+
+def iter_product_crops(pages=None, images_dir=None, catalog_path=None,
+                       configs=None, encode=None, options=None):
+    """
+    Crop products in memory, for use as a library: yields
+    (product_id, slug, crop) lazily, page by page, and writes nothing.
+
+    pages is a page number or an iterable of them (default: every page in
+    configs, which defaults to PAGE_CONFIGS); pages whose image is missing
+    are skipped, unless they were asked for by number. images_dir and
+    catalog_path default to IMAGES_DIR and CATALOG_PATH, and slug is the
+    product name slugified as in the output filenames. crop is a PIL image,
+    or the bytes of it encoded as encode if that is a format name ("png",
+    or one of VARIANT_SAVE_OPTIONS), or encode(image) if it is a callable.
+    options are those of iter_crops ("trim", "batch", "scale") and
+    open_page ("raw_cache"). As in iter_crops, a
+    product that could not be cropped yields the exception instead.
+    """
+    configs = PAGE_CONFIGS if configs is None else configs
+    if pages is None:
+        pages = [page_num for page_num in sorted(configs)
+                 if os.path.exists(page_path(page_num, images_dir))]
+    elif isinstance(pages, int):
+        pages = [pages]
+    pages = list(pages)
+
+    wanted = configured_ids({page_num: configs[page_num]
+                             for page_num in pages})
+    id_to_name = {prod_id: name for prod_id, name
+                  in iter_catalog(catalog_path or CATALOG_PATH)
+                  if prod_id in wanted}
+
+    encoder = _format_encoder(encode) if isinstance(encode, str) else encode
+
+    for page_num in pages:
+        tasks = page_tasks(page_num, configs[page_num], id_to_name,
+                           images_dir=images_dir)
+        try:
+            img, pixels = open_page(page_path(page_num, images_dir), options)
+        except Exception as e:
+            for prod_id, _, _, _ in tasks:
+                yield prod_id, slugify(id_to_name.get(prod_id, prod_id)), e
+            continue
+        with img:
+            crops = iter_crops(img, [task[3] for task in tasks
+                                     if task[3] is not None], options,
+                               pixels=pixels)
+            for prod_id, _, _, box in tasks:
+                if box is None:
+                    crop = ValueError(
+                        f"{prod_id}: no region detected on page {page_num}")
+                else:
+                    crop = next(crops)
+                if encoder is not None and not isinstance(crop, Exception):
+                    try:
+                        crop = encoder(crop)
+                    except Exception as e:
+                        crop = e
+                yield prod_id, slugify(id_to_name.get(prod_id, prod_id)), crop
+
+
+def run_serial(pages, cached, options=None, page_cache=None):
+    """Yield (page_num, results, stats) for each (page_num, tasks) in pages."""
+    for page_num, tasks in pages:
+        yield (page_num, *crop_page(page_num, tasks, cached, options,
+                                    page_cache))
+
+
+def run_pool(pages, cached, jobs, options=None):
+    """
+    Like run_serial, with pages cropped in a pool of jobs processes.
+    pages is consumed lazily, keeping at most 2 * jobs pages submitted.
+    The workers are handed IMAGES_DIR and OUTPUT_DIR as this process has
+    them: under the spawn and forkserver start methods they import the
+    module afresh and would see its defaults. (PAGE_CONFIGS needs no
+    passing, the tasks already carry their boxes.)
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    executor = ProcessPoolExecutor(max_workers=jobs)
+    pending = collections.deque()
+    try:
+        # Hand results back in page order so the log and the failed list
+        # match a serial run line for line.
+        for page_num, tasks in pages:
+            # Only this page's manifest entries: the whole manifest would be
+            # pickled again for every page.
+            page_cached = {t[2]: cached[t[2]] for t in tasks if t[2] in cached}
+            pending.append((page_num, executor.submit(
+                crop_page, page_num, tasks, page_cached, options, None,
+                IMAGES_DIR, OUTPUT_DIR)))
+            if len(pending) >= 2 * jobs:
+                page_num, future = pending.popleft()
+                yield (page_num, *future.result())
+        while pending:
+            page_num, future = pending.popleft()
+            yield (page_num, *future.result())
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+_STOP = object()
+
+
+def run_pipeline(pages, cached, decode_threads=2, crop_threads=1,
+                 encode_threads=2, write_threads=2, queue_size=4,
+                 options=None):
+    """
+    Like run_serial, as a streaming decode -> crop -> encode -> write
+    pipeline of thread pools joined by queues of queue_size items.
+    Pillow releases the GIL while inflating and deflating PNG data, so
+    decoding, encoding and disk writes overlap. At most
+    decode_threads + queue_size + crop_threads decoded pages are alive at
+    once, however many pages there are, and pages is consumed lazily.
+    """
+    page_q = queue.Queue(maxsize=queue_size)
+    crop_q = queue.Queue(maxsize=queue_size)
+    encode_q = queue.Queue(maxsize=queue_size)
+    write_q = queue.Queue(maxsize=queue_size)
+    # Unbounded so the last stage never blocks; holds one small tuple per crop.
+    done_q = queue.Queue()
+    # Page numbers in the order they were fed, for the collector below.
+    order_q = queue.Queue()
+
+    def decode(item):
+        page_num, tasks = item
+        stats = new_stats()
+        results, todo, digest = split_cached(page_num, tasks, cached, options,
+                                             stats)
+        img = None
+        if todo:
+            try:
+                with measure(stats["stages"], "decode") as m:
+                    img, pixels = open_page(page_path(page_num), options,
+                                            digest)
+                    m["bytes"] += (raster_bytes(img) if pixels is None
+                                   else pixels.nbytes)
+            except Exception as e:
+                fail_todo(results, todo, e)
+                img = None
+        # Queued before any of the page's crops can reach done_q.
+        done_q.put(("page", page_num, results, stats))
+        if img is not None:
+            crop_q.put((page_num, img, pixels, todo, stats))
+
+    def crop(item):
+        page_num, img, pixels, todo, stats = item
+        with img:
+            crops = iter_crops(img, [t[4] for t in todo], options, stats,
+                               pixels)
+            for i, prod_id, label, filename, box, key in todo:
+                meta = (prod_id, label, filename, key)
+                stages = stats["products"].setdefault(prod_id, {})
+                with measure(stages, "crop") as m:
+                    cropped = next(crops)
+                    if not isinstance(cropped, Exception):
+                        m["bytes"] += raster_bytes(cropped)
+                if isinstance(cropped, Exception):
+                    done_q.put(("crop", page_num, i,
+                                ("fail", *meta, str(cropped), None)))
+                    continue
+                encode_q.put((page_num, i, meta, stages, cropped))
+
+    def encode(item):
+        page_num, i, meta, stages, cropped = item
+        try:
+            files, info = encode_outputs(cropped, meta[2], options, stages)
+        except Exception as e:
+            done_q.put(("crop", page_num, i, ("fail", *meta, str(e), None)))
+            return
+        write_q.put((page_num, i, meta, stages, files, info))
+
+    def write(item):
+        page_num, i, meta, stages, files, info = item
+        try:
+            write_outputs(files, stages)
+        except Exception as e:
+            done_q.put(("crop", page_num, i, ("fail", *meta, str(e), None)))
+            return
+        done_q.put(("crop", page_num, i, ("ok", *meta, None, info)))
+
+    def start_stage(fn, inbox, threads, outbox, out_threads):
+        def loop():
+            while (item := inbox.get()) is not _STOP:
+                try:
+                    fn(item)
+                except BaseException as e:
+                    done_q.put(("error", e))
+
+        workers = [threading.Thread(target=loop, daemon=True)
+                   for _ in range(threads)]
+        for w in workers:
+            w.start()
+
+        def close():
+            for w in workers:
+                w.join()
+            for _ in range(out_threads):
+                outbox.put(_STOP)
+
+        if outbox is not None:
+            threading.Thread(target=close, daemon=True).start()
+
+    def feed():
+        try:
+            for item in pages:
+                order_q.put(item[0])
+                page_q.put(item)
+        except BaseException as e:
+            order_q.put(e)
+        finally:
+            order_q.put(_STOP)
+            for _ in range(decode_threads):
+                page_q.put(_STOP)
+
+    start_stage(decode, page_q, decode_threads, crop_q, crop_threads)
+    start_stage(crop, crop_q, crop_threads, encode_q, encode_threads)
+    start_stage(encode, encode_q, encode_threads, write_q, write_threads)
+    start_stage(write, write_q, write_threads, None, 0)
+    threading.Thread(target=feed, daemon=True).start()
+
+    # Reassemble per-page results and release them in page order.
+    collected = {}
+    page_stats = {}
+    while (page_num := order_q.get()) is not _STOP:
+        if isinstance(page_num, BaseException):
+            raise page_num
+        while page_num not in collected or None in collected[page_num]:
+            msg = done_q.get()
+            if msg[0] == "page":
+                collected[msg[1]] = msg[2]
+                page_stats[msg[1]] = msg[3]
+            elif msg[0] == "crop":
+                collected[msg[1]][msg[2]] = msg[3]
+            else:
+                raise msg[1]
+        yield page_num, collected.pop(page_num), page_stats.pop(page_num)
+
+
+PROFILE_STAGES = ("plan", "hash", "decode", "trim", "array", "crop",
+                  "encode", "write")
+
+
+def add_stage(total, entry):
+    for field in ("calls", "wall", "cpu", "bytes"):
+        total[field] = total.get(field, 0) + entry[field]
+
+
+def write_profile(path, page_stats, run, top=10):
+    """
+    Write the --profile report and print a summary.
+    page_stats maps page number -> stats (new_stats); run holds whole-run
+    wall and CPU seconds. The JSON report at path has the totals per stage
+    and the full per-page and per-product breakdown; a CSV next to it has
+    one row per page/product/stage for spreadsheets.
+    """
+    totals = {}
+    pages = {}
+    products = []
+    rows = []
+    for page_num, stats in sorted(page_stats.items()):
+        page_total = {}
+        for stage, entry in stats["stages"].items():
+            add_stage(totals.setdefault(stage, {}), entry)
+            add_stage(page_total, entry)
+            rows.append((page_num, "", stage, entry))
+        for prod_id, stages in stats["products"].items():
+            prod_total = {}
+            for stage, entry in stages.items():
+                add_stage(totals.setdefault(stage, {}), entry)
+                add_stage(page_total, entry)
+                add_stage(prod_total, entry)
+                rows.append((page_num, prod_id, stage, entry))
+            products.append((prod_total.get("wall", 0.0), prod_id, page_num))
+        pages[page_num] = dict(stats, total=page_total)
+
+    report = {"run": run, "totals": totals, "pages": pages}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    csv_path = os.path.splitext(path)[0] + ".csv"
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["page", "product", "stage", "calls", "wall_s",
+                         "cpu_s", "bytes"])
+        for page_num, prod_id, stage, e in rows:
+            writer.writerow([page_num, prod_id, stage, e["calls"],
+                             f"{e['wall']:.6f}", f"{e['cpu']:.6f}", e["bytes"]])
+
+    print(f"\nProfile ({run['wall']:.2f}s wall, {run['cpu']:.2f}s CPU "
+          f"in this process) -> {path}, {csv_path}")
+    print(f"  {'stage':<8} {'calls':>6} {'wall s':>9} {'cpu s':>9} {'MB':>9}")
+    order = [st for st in PROFILE_STAGES if st in totals]
+    order += sorted(set(totals) - set(order))
+    for stage in order:
+        e = totals[stage]
+        print(f"  {stage:<8} {e['calls']:>6} {e['wall']:>9.3f} "
+              f"{e['cpu']:>9.3f} {e['bytes'] / 1e6:>9.2f}")
+    slow_pages = sorted(pages.items(), key=lambda kv: -kv[1]["total"].get("wall", 0))
+    print("  Slowest pages:")
+    for page_num, stats in slow_pages[:top]:
+        print(f"    p{page_num:02d}  {stats['total'].get('wall', 0):.3f}s")
+    print("  Slowest products:")
+    for wall, prod_id, page_num in sorted(products, reverse=True)[:top]:
+        print(f"    {prod_id} (p{page_num:02d})  {wall:.3f}s")
+
+
+def format_detected(page_num, pairs, unmatched):
+    """Python source for one page of detected regions, in PAGE_CONFIGS style."""
+    found = sum(region is not None for _, region in pairs) + len(unmatched)
+    lines = [
+        f"    # ──── Page {page_num}: {found} regions for {len(pairs)} products ────",
+    ]
+    if any(prod_id is not None for prod_id, _ in pairs):
+        mismatch = region_mismatch(pairs, unmatched)
+        if mismatch:
+            lines.append(f"    # WARNING: {mismatch}, so the pairs "
+                         f"below are a guess")
+    lines += [
+        f"    {page_num}: {{",
+        '        "mode": "manual",',
+        '        "crops": [',
+    ]
+    for prod_id, region in pairs:
+        quoted = "None" if prod_id is None else f'"{prod_id}"'
+        if region is None:
+            lines.append(f"            # {quoted}: no region detected")
+        else:
+            lines.append(f"            ({quoted}, {', '.join(map(str, region))}),")
+    for region in unmatched:
+        lines.append(f"            # unmatched region: {tuple(region)}")
+    lines += ["        ]", "    },"]
+    return "\n".join(lines)
+
+
+def detect_pages(page_nums):
+    """
+    Run detect_regions on the given pages and return a reviewable config.
+    Configured pages are matched against their product IDs and searched
+    within their current content area; other pages get None IDs to fill in.
+    """
+    blocks = []
+    for page_num in page_nums:
+        config = PAGE_CONFIGS.get(page_num, {})
+        content_area = config.get("content_area")
+        if config.get("mode") == "manual":
+            ids = [entry[0] for entry in config["crops"]]
+            regions = np.array([entry[1:] for entry in config["crops"]])
+            content_area = (regions[:, 0].min(), regions[:, 1].min(),
+                            regions[:, 2].max(), regions[:, 3].max())
+        else:
+            ids = [pid for pid in config.get("products", []) if pid]
+
+        with reference_page(page_path(page_num)) as img:
+            regions = detect_regions(
+                img, content_area, config.get("threshold", AUTO_THRESHOLD))
+        if ids:
+            pairs, unmatched = match_regions(ids, regions)
+        else:
+            pairs = [(None, tuple(r)) for r in regions.tolist()]
+            unmatched = []
+        blocks.append(format_detected(page_num, pairs, unmatched))
+
+    return "\n".join([
+        "# Crop regions found by crop_products.py --detect.",
+        "# Review every box, then copy the pages you want into PAGE_CONFIGS.",
+        "DETECTED_CONFIGS = {",
+        *blocks,
+        "}",
+        "",
+    ])
+
+
+def dry_run():
+    """
+    Print the compiled crop plan, its validation and the catalog coverage
+    without decoding any page. The plan is cached in PLAN_PATH. Auto
+    pages are checked against the regions the last run detected, if they
+    are still valid. Returns 1 if validation found errors, else 0.
+    """
+    start = time.perf_counter()
+    id_to_name, missing = catalog_names(PAGE_CONFIGS)
+    catalog_ids = id_to_name.keys() | missing.keys()
+
+    plan_path = PLAN_PATH
+    key = plan_key(PAGE_CONFIGS, id_to_name)
+    plan = load_plan(plan_path, key)
+    source = "cached"
+    if plan is None:
+        plan = compile_plan(PAGE_CONFIGS, id_to_name)
+        save_plan(plan_path, plan, key)
+        source = "compiled"
+    issues = validate_plan(plan, PAGE_CONFIGS, catalog_ids)
+    for page_num in sorted(PAGE_CONFIGS):
+        if not os.path.exists(page_path(page_num)):
+            issues.append(("warning", page_num,
+                           f"{page_path(page_num)} not found"))
+
+    # Region counts of auto pages, from the detect cache of the last run
+    manifest = load_manifest(os.path.join(OUTPUT_DIR, MANIFEST_NAME))
+    detected = manifest["detected"]
+    auto_counts = {}
+    for page_num, config in sorted(PAGE_CONFIGS.items()):
+        if (config["mode"] != "auto"
+                or not os.path.exists(page_path(page_num))):
+            continue
+        entry = detected.get(str(page_num))
+        if not entry or entry["key"] != detect_key(page_num, config):
+            issues.append(("warning", page_num, f"p{page_num:02d}: regions "
+                           f"not detected yet (a crop run finds them)"))
+            continue
+        pairs, unmatched = match_regions(config["products"], entry["regions"])
+        auto_counts[page_num] = (len(entry["regions"]), len(unmatched))
+        mismatch = region_mismatch(pairs, unmatched)
+        if mismatch:
+            issues.append(("error", page_num, f"p{page_num:02d}: {mismatch}"
+                           f"; review the page with --detect {page_num}"))
+    issues.sort(key=lambda issue: (issue[1], issue[0] != "error"))
+    seconds = time.perf_counter() - start
+
+    modes = collections.Counter(
+        PAGE_CONFIGS[page_num]["mode"] for page_num in PAGE_CONFIGS)
+    print(f"Crop plan: {len(plan['page'])} crops on {len(PAGE_CONFIGS)} pages "
+          f"({', '.join(f'{n} {mode}' for mode, n in sorted(modes.items()))})")
+    for i in range(len(plan["page"])):
+        if plan["mode"][i] == "auto":
+            counts = auto_counts.get(int(plan["page"][i]))
+            box = ("(detected when cropped)" if counts is None
+                   else "(%d found, %d unmatched)" % counts)
+        else:
+            box = "(%d, %d, %d, %d)" % tuple(plan["box"][i].tolist())
+        print(f"  {plan_label(plan, i):<9} {plan['product'][i]:<14} "
+              f"{box:<24} -> {plan['filename'][i]}")
+
+    errors = sum(level == "error" for level, _, _ in issues)
+    print(f"\nChecks: {errors} error(s), {len(issues) - errors} warning(s)")
+    for level, _, message in issues:
+        print(f"  [{level.upper()}] {message}")
+
+    covered = len(catalog_ids) - len(missing)
+    print(f"\nCatalog coverage: {covered} of {len(catalog_ids)} products "
+          f"planned ({covered / max(1, len(catalog_ids)):.1%})")
+    print_coverage(missing)
+    print(f"\nPlan {source} and checked in {seconds * 1000:.1f} ms "
+          f"-> {plan_path}")
+    return 1 if errors else 0
+
+
+WATCH_INTERVAL = 0.5    # seconds between checks for changed inputs
+WATCH_CACHE_MB = 512    # decoded pages kept hot between --watch runs
+
+
+def read_page_configs(path):
+    """PAGE_CONFIGS as currently written in the script at path."""
+    with open(path, 'r', encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    for node in tree.body:
+        if (isinstance(node, ast.Assign)
+                and any(getattr(t, "id", None) == "PAGE_CONFIGS"
+                        for t in node.targets)):
+            return ast.literal_eval(node.value)
+    raise ValueError(f"no PAGE_CONFIGS in {path}")
+
+
+def watch_stamps(script):
+    """file_stamp of every input of a run: page images, catalog, configs."""
+    paths = [CATALOG_PATH, script]
+    if os.path.isdir(IMAGES_DIR):
+        paths += sorted(os.path.join(IMAGES_DIR, name)
+                        for name in os.listdir(IMAGES_DIR)
+                        if PAGE_RE.match(name))
+    return {path: file_stamp(path) for path in paths}
+
+
+def watch(args, jobs):
+    """
+    Run crop_catalog, then again every time a page image, the catalog or
+    PAGE_CONFIGS in this script changes, until interrupted. Decoded pages
+    stay in a page cache of args.watch_cache MB between runs, and the
+    manifest keys limit each run to the crops whose inputs changed.
+    """
+    global PAGE_CONFIGS
+    script = os.path.abspath(__file__)
+    page_cache = new_page_cache(args.watch_cache * 2**20)
+    stamps = None
+    print(f"Watching {IMAGES_DIR}, {CATALOG_PATH} and the PAGE_CONFIGS in "
+          f"{script} (Ctrl-C to stop)")
+    try:
+        while True:
+            current = watch_stamps(script)
+            if current == stamps:
+                time.sleep(args.watch_interval)
+                continue
+            # Wait for files still being written to settle.
+            while stamps is not None:
+                time.sleep(args.watch_interval)
+                settled, current = current, watch_stamps(script)
+                if current == settled:
+                    break
+            if stamps is not None:
+                changed = sorted(os.path.basename(path)
+                                 for path in stamps.keys() | current.keys()
+                                 if stamps.get(path) != current.get(path))
+                print(f"\n[WATCH] changed: {', '.join(changed)}")
+                if stamps.get(script) != current.get(script):
+                    try:
+                        PAGE_CONFIGS = read_page_configs(script)
+                    except (SyntaxError, ValueError) as e:
+                        print(f"[WATCH] keeping the previous PAGE_CONFIGS: {e}")
+            stamps = current
+
+            start = time.perf_counter()
+            try:
+                crop_catalog(args, jobs, page_cache)
+            except Exception as e:
+                print(f"[WATCH] run failed: {e}")
+            # --force applies to the first run only.
+            args.force = False
+            print(f"[WATCH] done in {time.perf_counter() - start:.2f}s, "
+                  f"{len(page_cache['pages'])} page(s) cached; "
+                  f"waiting for changes")
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+
+
+def int_list(text):
+    return [int(v) for v in text.split(",") if v.strip()]
+
+
+def format_list(text):
+    formats = [v.strip().lower() for v in text.split(",") if v.strip()]
+    for fmt in formats:
+        if fmt not in VARIANT_SAVE_OPTIONS:
+            raise argparse.ArgumentTypeError(f"unknown format {fmt!r}")
+    return formats
+
+
+def encoder_list(text):
+    names = [v.strip().lower() for v in text.split(",") if v.strip()]
+    for name in names:
+        if name not in ENCODERS:
+            raise argparse.ArgumentTypeError(f"unknown encoder {name!r}")
+    return names
+
+
+def shard_spec(text):
+    try:
+        shard, count = map(int, text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected I/N, got {text!r}")
+    if not 1 <= shard <= count:
+        raise argparse.ArgumentTypeError(f"shard {shard} is not in 1..{count}")
+    return shard, count
+
+
+COMMANDS = ("crop", "page", "single-page", "report", "list")
+
+
+def parse_args(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Without a command, the options are those of crop, as they always were
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ("-h", "--help")):
+        argv = ["crop", *argv]
+    parser = argparse.ArgumentParser(
+        description="Crop product images from catalog page images.")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    crop = commands.add_parser(
+        "crop", help="crop every page that is out of date (the default)",
+        description="Crop every page that is out of date.")
+    add_crop_arguments(crop)
+    crop.set_defaults(pages=None)
+    page = commands.add_parser(
+        "page", aliases=["single-page"],
+        help="crop only the given pages, keeping the rest of the manifest",
+        description="Crop only the given pages; outputs of other pages are "
+                    "left as they are.")
+    page.add_argument("pages", type=int, nargs="+", metavar="PAGE")
+    add_crop_arguments(page)
+    commands.add_parser(
+        "report", help="catalog coverage and output status, without "
+                       "decoding anything; exits 1 on problems",
+        description="Report configured products missing from the catalog or "
+                    "without an output, missing page images and catalog "
+                    "products no config crops.")
+    listing = commands.add_parser(
+        "list", help="list the configured products",
+        description="Print page, product ID and output file of every "
+                    "configured product, tab-separated.")
+    listing.add_argument(
+        "--catalog", action="store_true",
+        help="list every catalog product instead: ID, category, name and "
+             "the page that crops it (- for none)")
+
+    args = parser.parse_args(argv)
+    if args.command in ("crop", "page", "single-page"):
+        check_crop_args(page if args.pages else crop, args)
+    return args
+
+
+def add_crop_arguments(parser):
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, metavar="N",
+        help="crop pages in N worker processes (0 = one per CPU, default 1)")
+    parser.add_argument(
+        "--force", action="store_true",
+        help="re-crop everything, ignoring the manifest of the previous run")
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="decode each page once into a NumPy array and crop views of it")
+    parser.add_argument(
+        "--scale", type=float, default=1, metavar="X",
+        help="write crops at X times the reference page resolution "
+             f"({IMG_W}x{IMG_H}); larger scans are decoded reduced to just "
+             "above it (default 1)")
+    parser.add_argument(
+        "--trim", action="store_true",
+        help="shrink each crop to the content inside it (see trim_boxes)")
+    parser.add_argument(
+        "--trim-tolerance", type=int, default=TRIM_TOLERANCE, metavar="N",
+        help="grey levels below white still counted as background "
+             f"(default {TRIM_TOLERANCE})")
+    parser.add_argument(
+        "--trim-margin", type=int, default=TRIM_MARGIN, metavar="PX",
+        help=f"background kept around trimmed content (default {TRIM_MARGIN})")
+    parser.add_argument(
+        "--variants", action="store_true",
+        help="also write resized WebP/AVIF variants and a srcset manifest")
+    parser.add_argument(
+        "--widths", type=int_list, default=list(VARIANT_WIDTHS),
+        metavar="W,W,...",
+        help="variant widths (default %s)" % ",".join(map(str, VARIANT_WIDTHS)))
+    parser.add_argument(
+        "--formats", type=format_list, default=list(VARIANT_FORMATS),
+        metavar="FMT,...",
+        help="variant formats, in order of preference; unsupported ones are "
+             "dropped, falling back to png (default %s)"
+             % ",".join(VARIANT_FORMATS))
+    parser.add_argument(
+        "--variants-json", default=VARIANTS_JSON_PATH, metavar="PATH",
+        help=f"where to write the variant manifest (default {VARIANTS_JSON_PATH})")
+    optimize = parser.add_argument_group(
+        "size optimization", "try several PNG encodings of every crop and "
+        "keep the smallest that looks the same")
+    optimize.add_argument(
+        "--optimize", action="store_true",
+        help="encode crops with the candidates of --encoders and report the "
+             "bytes saved")
+    optimize.add_argument(
+        "--encoders", type=encoder_list, default=list(OPTIMIZE_ENCODERS),
+        metavar="NAME,...",
+        help="candidate encodings, from %s (default %s)"
+             % (",".join(ENCODERS), ",".join(OPTIMIZE_ENCODERS)))
+    optimize.add_argument(
+        "--max-error", type=float, default=OPTIMIZE_MAX_ERROR, metavar="E",
+        help="perceptual error (1 - SSIM in the worst colour channel) a "
+             "lossy candidate may add "
+             f"(default {OPTIMIZE_MAX_ERROR})")
+    optimize.add_argument(
+        "--byte-budget", type=int, metavar="KB",
+        help="prefer the least lossy candidate under KB kilobytes over the "
+             "smallest one")
+    profile = parser.add_argument_group(
+        "profiling", "record wall/CPU time and bytes for every stage, per "
+        "page and per product")
+    profile.add_argument("--profile", metavar="PATH", nargs="?",
+                         const="crop-profile.json",
+                         help="write the report to PATH (default "
+                              "crop-profile.json) plus a .csv next to it")
+    profile.add_argument("--profile-top", type=int, default=10, metavar="N",
+                         help="pages and products listed in the summary")
+    profile.add_argument("--cprofile", metavar="PATH",
+                         help="run the crop loop under cProfile and dump the "
+                              "stats to PATH (this process only, so not "
+                              "the --jobs workers)")
+    profile.add_argument("--tracemalloc", action="store_true",
+                         help="trace Python allocations in the crop loop and "
+                              "print the peak and the top allocation sites")
+    parser.add_argument(
+        "--dedupe", action="store_true",
+        help="group near-duplicate crops by perceptual hash, keep one file "
+             "per group and write a product -> shared asset map")
+    parser.add_argument(
+        "--dedupe-threshold", type=int, default=DEDUPE_THRESHOLD, metavar="N",
+        help="hash bits (of 64) two crops may differ in and still count as "
+             f"duplicates (default {DEDUPE_THRESHOLD})")
+    parser.add_argument(
+        "--dedupe-json", default=DEDUPE_JSON_PATH, metavar="PATH",
+        help=f"where to write the shared asset map (default {DEDUPE_JSON_PATH})")
+    parser.add_argument(
+        "--placeholders", action="store_true",
+        help="compute a tiny blurred placeholder and the mean and dominant "
+             "colors of every crop, into a JSON sidecar keyed by product ID")
+    parser.add_argument(
+        "--placeholders-json", default=PLACEHOLDER_JSON_PATH, metavar="PATH",
+        help=f"where to write the placeholders (default {PLACEHOLDER_JSON_PATH})")
+    parser.add_argument(
+        "--atlas", action="store_true",
+        help="also pack each catalog category's thumbnails into sprite "
+             f"sheets with a JSON map, under OUTPUT_DIR/{ATLAS_SUBDIR}")
+    parser.add_argument(
+        "--atlas-size", type=int, default=ATLAS_THUMB, metavar="PX",
+        help=f"longest side of an atlas thumbnail (default {ATLAS_THUMB})")
+    parser.add_argument(
+        "--raw-cache", metavar="DIR", nargs="?", const=RAW_CACHE_DIR,
+        help="keep every decoded page as a raw array in DIR (default "
+             f"{RAW_CACHE_DIR}), keyed by its content, and crop from memory "
+             "maps of those instead of decoding the PNGs again")
+    parser.add_argument(
+        "--qa", metavar="PATH", nargs="?", const="crop-qa.json",
+        help="score every crop for signs of a bad box (mostly background, "
+             "caption text, content cut at an edge, same as a neighbour) and "
+             "write a ranked report to PATH (default crop-qa.json) plus a "
+             "contact sheet .png next to it")
+    parser.add_argument(
+        "--qa-top", type=int, default=QA_TOP, metavar="N",
+        help=f"crops on the contact sheet (default {QA_TOP})")
+    parser.add_argument(
+        "--max-memory", type=int, metavar="MB",
+        help="cap the decoded pages held at once (by --jobs workers or the "
+             "pipeline) to about MB megabytes")
+    parser.add_argument(
+        "--plan", "--dry-run", action="store_true",
+        help="print the crop plan, config errors and catalog coverage "
+             "without decoding any page; exits 1 on config errors")
+    parser.add_argument(
+        "--detect", type=int, nargs="*", metavar="PAGE",
+        help="detect product regions on these pages (default: every page "
+             "image) and print them as a config to review instead of cropping")
+    parser.add_argument(
+        "--detect-out", metavar="PATH",
+        help="write the --detect config to PATH instead of stdout")
+
+    sharding = parser.add_argument_group(
+        "sharding", "split a run across CI runners, then merge the results")
+    sharding.add_argument(
+        "--shard", type=shard_spec, metavar="I/N",
+        help="crop only shard I of N (pages balanced by estimated cost) and "
+             "write a partial result instead of the manifest")
+    sharding.add_argument(
+        "--merge", action="store_true",
+        help="merge the partial results of all N shards from OUTPUT_DIR into "
+             "the manifest and print the full report")
+
+    watching = parser.add_argument_group(
+        "watch", "stay running and re-crop whenever a page image, the "
+        "catalog or PAGE_CONFIGS changes")
+    watching.add_argument("--watch", action="store_true",
+                          help="enable watch mode")
+    watching.add_argument("--watch-interval", type=float,
+                          default=WATCH_INTERVAL, metavar="SECONDS",
+                          help="how often to check for changes "
+                               f"(default {WATCH_INTERVAL})")
+    watching.add_argument("--watch-cache", type=int, default=WATCH_CACHE_MB,
+                          metavar="MB",
+                          help="decoded pages kept between runs "
+                               f"(default {WATCH_CACHE_MB} MB)")
+
+    pipeline = parser.add_argument_group(
+        "pipeline", "run as a threaded decode -> crop -> encode -> write "
+        "pipeline with bounded queues between the stages")
+    pipeline.add_argument("--pipeline", action="store_true",
+                          help="enable the staged pipeline")
+    pipeline.add_argument("--decode-threads", type=int, default=2, metavar="N")
+    pipeline.add_argument("--crop-threads", type=int, default=1, metavar="N")
+    pipeline.add_argument("--encode-threads", type=int, default=2, metavar="N")
+    pipeline.add_argument("--write-threads", type=int, default=2, metavar="N")
+    pipeline.add_argument("--queue-size", type=int, default=4, metavar="N",
+                          help="capacity of each queue between stages "
+                               "(default 4)")
+
+
+
+def check_crop_args(parser, args):
+    if args.pages and (args.shard or args.merge or args.watch):
+        parser.error("page cannot be combined with --shard, --merge or "
+                     "--watch")
+    if args.pipeline and args.jobs != 1:
+        parser.error("--pipeline and --jobs cannot be combined")
+    if args.shard and (args.merge or args.watch):
+        parser.error("--shard cannot be combined with --merge or --watch")
+    if args.watch and (args.pipeline or args.jobs != 1):
+        parser.error("--watch keeps pages in this process; it cannot be "
+                     "combined with --pipeline or --jobs")
+    for name in ("decode_threads", "crop_threads", "encode_threads",
+                 "write_threads", "queue_size"):
+        if getattr(args, name) < 1:
+            parser.error(f"--{name.replace('_', '-')} must be at least 1")
+    if args.max_memory is not None and args.max_memory < 1:
+        parser.error("--max-memory must be at least 1")
+    if args.watch and args.raw_cache:
+        parser.error("--watch keeps decoded pages in memory; drop --raw-cache")
+    if not args.scale > 0:
+        parser.error("--scale must be positive")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "report":
+        raise SystemExit(report())
+    if args.command == "list":
+        list_products(args.catalog)
+        return
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+
+    if args.detect is not None:
+        page_nums = args.detect or sorted({
+            int(m.group(1)) for m in map(PAGE_RE.match, os.listdir(IMAGES_DIR))
+            if m})
+        text = detect_pages(page_nums)
+        if args.detect_out:
+            with open(args.detect_out, 'w') as f:
+                f.write(text)
+            print(f"Wrote detected regions for {len(page_nums)} pages "
+                  f"to {args.detect_out}")
+        else:
+            print(text, end="")
+        return
+
+    if args.plan:
+        raise SystemExit(dry_run())
+    if args.merge:
+        merge_shards(args)
+    elif args.watch:
+        watch(args, jobs)
+    else:
+        crop_catalog(args, jobs)
+
+
+def page_products(config):
+    """Product IDs of a page config in config order (empty cells left out)."""
+    if config["mode"] == "manual":
+        return [entry[0] for entry in config["crops"] if entry[0]]
+    return [pid for pid in config["products"] if pid]
+
+
+def report():
+    """
+    Print catalog coverage and output status from the configs, the catalog
+    index and the files in OUTPUT_DIR alone, without loading any image (or
+    needing a manifest: a fresh clone has the outputs but none). Returns 1
+    if a configured product is missing from the catalog or has no output.
+    """
+    index = catalog_index(CATALOG_PATH)
+    names = {prod_id: name for prod_id, name, _ in index}
+    existing = (set(os.listdir(OUTPUT_DIR)) if os.path.isdir(OUTPUT_DIR)
+                else set())
+    # Products --dedupe stored as another product's crop
+    try:
+        with open(DEDUPE_JSON_PATH, 'r') as f:
+            shared = json.load(f)["assets"]
+    except (OSError, ValueError, KeyError):
+        shared = {}
+    outputs = set()
+
+    unknown, uncropped, no_page = [], [], []
+    configured = 0
+    for page_num, config in sorted(PAGE_CONFIGS.items()):
+        if not os.path.exists(page_path(page_num)):
+            no_page.append(page_num)
+        for prod_id in page_products(config):
+            configured += 1
+            if prod_id not in names:
+                unknown.append((page_num, prod_id))
+            elif (product_filename(prod_id, names) in existing
+                  or shared.get(prod_id) in existing):
+                outputs.add(prod_id)
+            else:
+                uncropped.append((page_num, prod_id))
+
+    print(f"{len(index)} catalog products, {configured} configured on "
+          f"{len(PAGE_CONFIGS)} pages, {len(outputs)} with an output in "
+          f"{OUTPUT_DIR}/")
+    if no_page:
+        print(f"Page images missing: {', '.join(map(str, no_page))}")
+    if unknown:
+        print(f"Configured but not in the catalog ({len(unknown)}):")
+        for page_num, prod_id in unknown:
+            print(f"  - p{page_num:02d} {prod_id}")
+    if uncropped:
+        print(f"Configured but without an output ({len(uncropped)}):")
+        for page_num, prod_id in uncropped:
+            print(f"  - p{page_num:02d} {prod_id}: {names[prod_id]}")
+    cropped_ids = configured_ids(PAGE_CONFIGS)
+    print_coverage({prod_id: name for prod_id, name in names.items()
+                    if prod_id not in cropped_ids})
+    return 1 if unknown or uncropped else 0
+
+
+def list_products(catalog=False):
+    """Print the configured products, or with catalog every catalog one."""
+    index = catalog_index(CATALOG_PATH)
+    pages = {prod_id: page_num
+             for page_num, config in sorted(PAGE_CONFIGS.items(), reverse=True)
+             for prod_id in page_products(config)}
+    if catalog:
+        for prod_id, name, category in index:
+            print(f"{prod_id}\t{category}\t{name}\t{pages.get(prod_id, '-')}")
+        return
+    id_to_name = {prod_id: name for prod_id, name, _ in index}
+    for page_num, config in sorted(PAGE_CONFIGS.items()):
+        for prod_id in page_products(config):
+            print(f"{page_num}\t{prod_id}\t"
+                  f"{product_filename(prod_id, id_to_name)}")
+
+
+def crop_catalog(args, jobs, page_cache=None):
+    """
+    One full run: crop every configured page that is out of date, prune
+    stale outputs, save the manifest and print the summary. page_cache (see
+    new_page_cache) keeps decoded pages and page digests between runs.
+    """
+    id_to_name, missing = catalog_names(PAGE_CONFIGS)
 
     os.makedirs(OUTPUT_DIR, exist_ok=True)
+    manifest_path = os.path.join(OUTPUT_DIR, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    old_files = manifest["files"]
+    # A product stored as a shared asset is up to date while that asset is
+    # on disk and still configured (pruned otherwise)
+    configured = {product_filename(prod_id, id_to_name)
+                  for prod_id in configured_ids(PAGE_CONFIGS)}
+    cached = {} if args.force else {
+        filename: (entry["key"], stored_file(filename, entry)
+                   if entry.get("asset") in configured else filename)
+        for filename, entry in old_files.items()}
+    detected = {} if args.force else manifest["detected"]
+    detected = {key: entry for key, entry in detected.items()
+                if PAGE_CONFIGS.get(int(key), {}).get("mode") == "auto"}
 
     total_cropped = 0
+    total_skipped = 0
     failed = []
 
-    for page_num, config in sorted(PAGE_CONFIGS.items()):
-        page_file = os.path.join(IMAGES_DIR, f"page-{page_num:02d}.png")
-        if not os.path.exists(page_file):
-            print(f"  WARNING: {page_file} not found, skipping page {page_num}")
+    pages = sorted(PAGE_CONFIGS.items())
+    # Outputs and detected regions of the pages left out of this run
+    other_files, other_detected = {}, {}
+    mine = None
+    if args.shard:
+        mine = set(shard_pages(PAGE_CONFIGS, *args.shard))
+        print(f"Shard {args.shard[0]}/{args.shard[1]}: {len(mine)} of "
+              f"{len(PAGE_CONFIGS)} pages")
+    elif args.pages:
+        mine = set(args.pages)
+        unknown = sorted(mine - PAGE_CONFIGS.keys())
+        if unknown:
+            raise SystemExit(f"error: no config for page(s) "
+                             f"{', '.join(map(str, unknown))}")
+    if mine is not None:
+        pages = [(page_num, config) for page_num, config in pages
+                 if page_num in mine]
+        other_files = {fn: entry for fn, entry in old_files.items()
+                       if entry.get("page") not in mine}
+        old_files = {fn: entry for fn, entry in old_files.items()
+                     if entry.get("page") in mine}
+        other_detected = {key: entry for key, entry in detected.items()
+                          if int(key) not in mine}
+        detected = {key: entry for key, entry in detected.items()
+                    if int(key) in mine}
+    present = {page_num for page_num, _ in pages
+               if os.path.exists(page_path(page_num))}
+    # Per-page profiles are only kept for --profile; tasks are planned as
+    # the runner asks for them, so only pages in flight hold any.
+    page_stats = {}
+    plan_stats = {}
+    planned = set()
+
+    def plan(page_num, config):
+        stats = plan_stats[page_num] = new_stats()
+        with measure(stats["stages"], "plan"):
+            return page_tasks(page_num, config, id_to_name, detected)
+
+    def planned_pages():
+        for page_num, config in pages:
+            if page_num in present:
+                yield page_num, plan(page_num, config)
+
+    options = {
+        "batch": args.batch,
+        "trim": (args.trim_tolerance, args.trim_margin) if args.trim else None,
+        "scale": args.scale,
+        "raw_cache": args.raw_cache,
+        "placeholders": args.placeholders,
+        "optimize": args.optimize and {
+            "encoders": args.encoders, "max_error": args.max_error,
+            "budget": args.byte_budget and args.byte_budget * 1024},
+        "variants": args.variants and {
+            "widths": args.widths,
+            "formats": supported_formats(args.formats),
+        },
+    }
+    if args.max_memory and present:
+        limit = pages_in_flight(args.max_memory * 2**20, present)
+        if args.pipeline:
+            args.decode_threads = min(args.decode_threads, max(1, limit // 3))
+            args.crop_threads = min(args.crop_threads, max(1, limit // 3))
+            args.queue_size = min(args.queue_size, max(
+                1, limit - args.decode_threads - args.crop_threads))
+        else:
+            jobs = min(jobs, limit)
+        print(f"Memory cap {args.max_memory} MB: "
+              f"at most {limit} decoded page(s) in flight")
+    if args.pipeline:
+        page_results = run_pipeline(
+            planned_pages(), cached,
+            decode_threads=args.decode_threads,
+            crop_threads=args.crop_threads,
+            encode_threads=args.encode_threads,
+            write_threads=args.write_threads,
+            queue_size=args.queue_size,
+            options=options)
+    elif jobs > 1:
+        page_results = run_pool(planned_pages(), cached, jobs, options)
+    else:
+        page_results = run_serial(planned_pages(), cached, options,
+                                  page_cache)
+
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    run_wall, run_cpu = time.perf_counter(), time.process_time()
+
+    new_files = dict(old_files)
+    for page_num, config in pages:
+        if page_num not in present:
+            # Entries for pages that are missing this run are kept as they are.
+            planned.update(task[2] for task in plan(page_num, config))
+            if args.profile:
+                page_stats[page_num] = plan_stats[page_num]
+            del plan_stats[page_num]
+            print(f"  WARNING: {page_path(page_num)} not found, "
+                  f"skipping page {page_num}")
             continue
 
-        img = Image.open(page_file)
+        _, results, stats = next(page_results)
+        stats["stages"].update(plan_stats.pop(page_num)["stages"])
+        if args.profile:
+            page_stats[page_num] = stats
+        if config["mode"] == "auto" and str(page_num) in detected:
+            mismatch = region_mismatch(*match_regions(
+                config["products"], detected[str(page_num)]["regions"]))
+            if mismatch:
+                print(f"  [FAIL] p{page_num:02d}: {mismatch}; review the "
+                      f"page with --detect {page_num}")
+        for status, prod_id, label, filename, key, error, info in results:
+            planned.add(filename)
+            if status == "fail":
+                failed.append((page_num, prod_id, error))
+                new_files.pop(filename, None)
+                print(f"  [FAIL] p{page_num:02d} {prod_id}: {error}")
+                continue
+            if status == "skip":
+                info = {k: v for k, v in old_files[filename].items()
+                        if k not in ("key", "product", "page")}
+            new_files[filename] = {
+                "key": key, "product": prod_id, "page": page_num, **info}
+            if status == "skip":
+                total_skipped += 1
+            else:
+                total_cropped += 1
+                saved = ""
+                if "encoder" in info:
+                    saved = (f" ({info['encoder']}, {info['png_bytes']} -> "
+                             f"{info['bytes']} bytes, "
+                             f"{info['bytes'] / info['png_bytes'] - 1:+.0%})")
+                print(f"  [OK] {label} -> {filename}{saved}")
+
+    run = {"wall": time.perf_counter() - run_wall,
+           "cpu": time.process_time() - run_cpu}
+    if profiler:
+        import pstats
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+        print(f"\ncProfile stats -> {args.cprofile}")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        print(f"\ntracemalloc: peak {peak / 1e6:.1f} MB, "
+              f"current {current / 1e6:.1f} MB; top allocation sites:")
+        for stat in snapshot.statistics("lineno")[:10]:
+            print(f"  {stat}")
+
+    new_files = {fn: entry for fn, entry in new_files.items() if fn in planned}
+
+    prune_outputs(old_files, new_files, planned)
+    if args.shard:
+        save_shard(args.shard, {
+            "pages": [page_num for page_num, _ in pages],
+            "planned": sorted(planned), "files": new_files,
+            "detected": detected, "cropped": total_cropped,
+            "skipped": total_skipped, "failed": failed})
+    else:
+        finish_outputs(args, manifest_path, {**other_files, **new_files},
+                       {**other_detected, **detected})
 
-        if config["mode"] == "manual":
-            for entry in config["crops"]:
-                prod_id = entry[0]
-                region = entry[1:]
-                if prod_id is None:
-                    continue
-                name = id_to_name.get(prod_id, prod_id)
-                slug = slugify(name)
-                filename = f"{prod_id}_{slug}.png"
-                try:
-                    cropped = crop_region(img, region)
-                    cropped.save(os.path.join(OUTPUT_DIR, filename))
-                    total_cropped += 1
-                    print(f"  [OK] p{page_num:02d} -> {filename}")
-                except Exception as e:
-                    failed.append((prod_id, str(e)))
-                    print(f"  [FAIL] p{page_num:02d} {prod_id}: {e}")
-
-        elif config["mode"] == "grid":
-            content_area = config["content_area"]
-            rows = config["rows"]
-            cols = config["cols"]
-            products = config["products"]
-            photo_ratio = config.get("photo_ratio", 0.60)
-
-            for idx, prod_id in enumerate(products):
-                if prod_id is None:
-                    continue
-                name = id_to_name.get(prod_id, prod_id)
-                slug = slugify(name)
-                filename = f"{prod_id}_{slug}.png"
-                try:
-                    cropped = crop_grid(img, content_area, rows, cols, idx,
-                                       photo_ratio=photo_ratio)
-                    cropped.save(os.path.join(OUTPUT_DIR, filename))
-                    total_cropped += 1
-                    print(f"  [OK] p{page_num:02d} [{idx}] -> {filename}")
-                except Exception as e:
-                    failed.append((prod_id, str(e)))
-                    print(f"  [FAIL] p{page_num:02d} {prod_id}: {e}")
+    print_summary(total_cropped, total_skipped, failed)
+    print_savings(new_files)
+    if args.profile:
+        write_profile(args.profile, page_stats, run, args.profile_top)
+    if mine is None:
+        print_coverage(missing)
 
+
+def prune_outputs(old_files, new_files, planned):
+    """
+    Delete outputs from earlier runs that no config entry produces any
+    more, and variants that the current settings no longer ask for.
+    """
+    stale = set()
+    for filename, entry in old_files.items():
+        old_names = {filename} | set(entry_variants(entry))
+        if filename not in planned:
+            stale |= old_names
+        elif filename in new_files:
+            stale |= old_names - {filename} - set(entry_variants(new_files[filename]))
+    for name in sorted(stale):
+        out_file = os.path.join(OUTPUT_DIR, name)
+        if os.path.exists(out_file):
+            os.remove(out_file)
+            print(f"  [PRUNE] {name}")
+
+
+def finish_outputs(args, manifest_path, files, detected):
+    """Save the manifest and write the whole-catalog extras asked for."""
+    if args.dedupe:
+        write_dedupe(args.dedupe_json, files, args.dedupe_threshold)
+    if args.placeholders:
+        write_placeholders(args.placeholders_json, files)
+    save_manifest(manifest_path, files, detected)
+    if args.variants:
+        write_variants_json(args.variants_json, files)
+    if args.atlas:
+        write_atlases(files, args.atlas_size)
+    if args.qa:
+        write_qa(args.qa, files, args.qa_top,
+                 args.trim_margin if args.trim else None, args.scale or 1)
+
+
+def print_summary(total_cropped, total_skipped, failed):
     print(f"\n{'='*60}")
     print(f"Done! Cropped {total_cropped} product images to {OUTPUT_DIR}/")
+    if total_skipped:
+        print(f"Unchanged: {total_skipped} (already up to date, skipped)")
     if failed:
         print(f"Failed: {len(failed)}")
-        for pid, err in failed:
+        for _, pid, err in failed:
             print(f"  - {pid}: {err}")
     else:
         print("No failures!")
 
-    # Report any products in catalog that weren't cropped
-    all_cropped_ids = set()
-    for config in PAGE_CONFIGS.values():
-        if config["mode"] == "manual":
-            for entry in config["crops"]:
-                if entry[0]:
-                    all_cropped_ids.add(entry[0])
-        elif config["mode"] == "grid":
-            for pid in config["products"]:
-                if pid:
-                    all_cropped_ids.add(pid)
-
-    all_catalog_ids = set()
-    for cat in catalog['categories']:
-        for prod in cat['products']:
-            all_catalog_ids.add(prod['id'])
-
-    missing = all_catalog_ids - all_cropped_ids
+
+def print_coverage(missing):
+    """Report any products in catalog that weren't cropped."""
     if missing:
         print(f"\nProducts in catalog but NOT cropped ({len(missing)}):")
         for pid in sorted(missing):
-            name = id_to_name.get(pid, "?")
-            print(f"  - {pid}: {name}")
+            print(f"  - {pid}: {missing[pid]}")
+
+
+def shard_pages(configs, shard, count):
+    """
+    The page numbers of shard (1-based) out of count. Pages are dealt to
+    the least loaded shard, most expensive first, with ties going to the
+    lower shard and page number, so every runner computes the same split.
+    A page costs its pixel count (decode, read from the image header) plus
+    the area of its crop boxes (crop and encode); each product of an auto
+    page is counted at the mean box area of the configured ones.
+    """
+    plan = compile_plan(configs, {})
+    box = plan["box"]
+    area = (box[:, 2] - box[:, 0]) * (box[:, 3] - box[:, 1])
+    fixed = plan["mode"] != "auto"
+    area[~fixed] = area[fixed].mean() if fixed.any() else IMG_W * IMG_H // 10
+
+    costs = {}
+    for page_num in configs:
+        path = page_path(page_num)
+        if os.path.exists(path):
+            with Image.open(path) as img:
+                costs[page_num] = img.width * img.height
+        else:
+            costs[page_num] = 0
+    for page_num, a in zip(plan["page"].tolist(), area.tolist()):
+        costs[page_num] += a
+
+    loads = [0] * count
+    owned = [[] for _ in range(count)]
+    for page_num in sorted(costs, key=lambda n: (-costs[n], n)):
+        k = loads.index(min(loads))
+        loads[k] += costs[page_num]
+        owned[k].append(page_num)
+    return sorted(owned[shard - 1])
+
+
+SHARD_RE = re.compile(r"\.crop-shard-(\d+)-of-(\d+)\.json$")
+
+
+def shard_result_path(shard, count):
+    return os.path.join(OUTPUT_DIR, f".crop-shard-{shard}-of-{count}.json")
+
+
+def save_shard(shard, result):
+    """Write a shard's partial result for --merge."""
+    path = shard_result_path(*shard)
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump({"version": MANIFEST_VERSION, "shard": shard[0],
+                   "of": shard[1], **result}, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+    print(f"Shard result -> {path}")
+
+
+def merge_shards(args):
+    """
+    Combine the partial results of a --shard i/N run, gathered into
+    OUTPUT_DIR, into the manifest and print the report a single run would:
+    totals, failures in page order and catalog coverage. Outputs of config
+    entries that no shard planned are pruned, the whole-catalog extras
+    (--variants, --dedupe, --placeholders, --atlas) written and the
+    partials removed.
+    """
+    parts = []
+    for name in sorted(os.listdir(OUTPUT_DIR) if os.path.isdir(OUTPUT_DIR)
+                       else []):
+        if SHARD_RE.match(name):
+            with open(os.path.join(OUTPUT_DIR, name), 'r') as f:
+                parts.append(json.load(f))
+    counts = {part["of"] for part in parts}
+    if len(counts) != 1:
+        raise SystemExit(f"error: expected the partial results of one "
+                         f"sharded run in {OUTPUT_DIR}, found counts "
+                         f"{sorted(counts) or 'none'}")
+    count = counts.pop()
+    shards = sorted(part["shard"] for part in parts)
+    if shards != list(range(1, count + 1)) or any(
+            part["version"] != MANIFEST_VERSION for part in parts):
+        raise SystemExit(f"error: need shards 1..{count} of one version, "
+                         f"found {shards}")
+
+    files, detected, planned, failed = {}, {}, set(), []
+    total_cropped = total_skipped = 0
+    for part in sorted(parts, key=lambda part: part["shard"]):
+        files.update(part["files"])
+        detected.update(part["detected"])
+        planned.update(part["planned"])
+        failed += [tuple(f) for f in part["failed"]]
+        total_cropped += part["cropped"]
+        total_skipped += part["skipped"]
+    failed.sort(key=lambda f: f[0])
+    print(f"Merged {count} shard(s): {sum(len(p['pages']) for p in parts)} "
+          f"pages")
+
+    manifest_path = os.path.join(OUTPUT_DIR, MANIFEST_NAME)
+    old_files = load_manifest(manifest_path)["files"]
+    prune_outputs({fn: entry for fn, entry in old_files.items()
+                   if fn not in planned}, files, planned)
+    finish_outputs(args, manifest_path, files, detected)
+    for shard in shards:
+        os.remove(shard_result_path(shard, count))
+
+    print_summary(total_cropped, total_skipped, failed)
+    print_savings(files)
+    print_coverage(catalog_names(PAGE_CONFIGS)[1])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Serve product crops on demand, for previews and local development.
+
+    python crop_server.py                 # http://127.0.0.1:8765
+    curl http://127.0.0.1:8765/deli-001.webp?w=320
+
+GET /{product_id}.{fmt}[?w=WIDTH] crops the product from its catalog page
+with the boxes of PAGE_CONFIGS in crop_products.py, scales it down to WIDTH
+if given and encodes it as png, webp or avif (as in --variants). Nothing is
+written to disk. Decoded pages and encoded crops live in two LRU caches
+bounded in MB. Every response carries an ETag derived from the page bytes,
+the box and the encoding, so a conditional request for an unchanged crop is
+answered 304 without decoding anything. GET /_stats reports the caches.
+Requests are handled concurrently; Pillow releases the GIL while decoding
+and encoding.
+"""
+import argparse
+import collections
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+import crop_products
+
+HOST = "127.0.0.1"
+PORT = 8765
+PAGE_CACHE_MB = 256
+CROP_CACHE_MB = 64
+
+CONTENT_TYPES = {"png": "image/png", "webp": "image/webp",
+                 "avif": "image/avif"}
+URL_RE = re.compile(r"/([^/]+)\.(png|webp|avif)")
+
+
+class LRUCache:
+    """
+    Thread-safe mapping holding at most limit bytes (as measured by size),
+    evicting the least recently used entries first.
+    """
+
+    def __init__(self, limit, size):
+        self.limit = limit
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.loading = {}
+
+    def get_or_make(self, key, make):
+        """The cached value for key, calling make() once on a miss even if
+        several threads ask for the same key at the same time."""
+        with self.lock:
+            if key in self.items:
+                self.hits += 1
+                self.items.move_to_end(key)
+                return self.items[key]
+            self.misses += 1
+            key_lock = self.loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in self.items:
+                    return self.items[key]
+            try:
+                value = make()
+            except BaseException:
+                with self.lock:
+                    self.loading.pop(key, None)
+                raise
+            # Stored and unmarked in one step: a request arriving in between
+            # would find neither and make the value again.
+            with self.lock:
+                self.items[key] = value
+                self.loading.pop(key, None)
+                self.bytes += self.size(value)
+                while self.bytes > self.limit and len(self.items) > 1:
+                    _, old = self.items.popitem(last=False)
+                    self.bytes -= self.size(old)
+            return value
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.items), "bytes": self.bytes,
+                    "limit": self.limit, "hits": self.hits,
+                    "misses": self.misses}
+
+
+class CropService:
+    """Product lookup, ETags and rendering, shared by all request threads."""
+
+    def __init__(self, page_cache_mb=PAGE_CACHE_MB,
+                 crop_cache_mb=CROP_CACHE_MB, options=None):
+        self.options = options or {}
+        self.formats = set(crop_products.supported_formats(CONTENT_TYPES))
+        # Evicted pages are not closed: another thread may still be
+        # cropping from them, so they are left to the garbage collector.
+        self.pages = LRUCache(page_cache_mb * 2**20, crop_products.raster_bytes)
+        self.crops = LRUCache(crop_cache_mb * 2**20, len)
+        self.digests = {"digests": {}}
+        self.detected = {}
+        self.script = os.path.abspath(crop_products.__file__)
+        self.script_stamp = crop_products.file_stamp(self.script)
+        self.configs = crop_products.PAGE_CONFIGS
+        self.lock = threading.Lock()
+        self.products = self.index(self.configs)
+
+    @staticmethod
+    def index(configs):
+        """product ID -> (page_num, box or None for auto pages)."""
+        plan = crop_products.compile_plan(configs, {})
+        products = {}
+        for page_num, prod_id, mode, box in zip(
+                plan["page"].tolist(), plan["product"].tolist(),
+                plan["mode"].tolist(), plan["box"].tolist()):
+            products.setdefault(
+                prod_id, (page_num, None if mode == "auto" else tuple(box)))
+        return products
+
+    def reload(self):
+        """Pick up PAGE_CONFIGS edits in crop_products.py; keep the old
+        configs if the script does not parse."""
+        stamp = crop_products.file_stamp(self.script)
+        with self.lock:
+            if stamp == self.script_stamp:
+                return
+            self.script_stamp = stamp
+            try:
+                configs = crop_products.read_page_configs(self.script)
+            except (SyntaxError, ValueError) as e:
+                print(f"Keeping the previous PAGE_CONFIGS: {e}")
+                return
+            self.configs, self.products = configs, self.index(configs)
+            print(f"Reloaded PAGE_CONFIGS: {len(self.products)} products")
+
+    def locate(self, prod_id):
+        """(page_num, box) of a product; KeyError if it is not configured,
+        box None for an auto product no region was detected for."""
+        self.reload()
+        configs, products = self.configs, self.products
+        page_num, box = products[prod_id]
+        if box is None:
+            tasks = crop_products.page_tasks(
+                page_num, configs[page_num], {}, self.detected)
+            box = dict((task[0], task[3]) for task in tasks)[prod_id]
+        return page_num, box
+
+    def etag(self, page_num, box, fmt, width):
+        path = crop_products.page_path(page_num)
+        digest = crop_products.cached_digest(path, self.digests)
+        save = (crop_products.PNG_SAVE_OPTIONS if fmt == "png"
+                else crop_products.VARIANT_SAVE_OPTIONS[fmt])
+        payload = json.dumps([digest, list(box), fmt, width, save,
+                              self.options.get("trim")], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+    def page(self, page_num):
+        path = crop_products.page_path(page_num)
+        return self.pages.get_or_make(
+            (path, crop_products.file_stamp(path)),
+            lambda: crop_products.load_page(path))
+
+    def render(self, page_num, box, fmt, width, etag):
+        def make():
+            cropped = next(crop_products.iter_crops(
+                self.page(page_num), [box], self.options))
+            if isinstance(cropped, Exception):
+                raise cropped
+            if width and width < cropped.width:
+                height = max(1, round(cropped.height * width / cropped.width))
+                cropped = cropped.resize((width, height), Image.LANCZOS)
+            if fmt == "png":
+                save = crop_products.PNG_SAVE_OPTIONS
+            else:
+                save = crop_products.VARIANT_SAVE_OPTIONS[fmt]
+                if cropped.mode not in ("RGB", "RGBA", "L", "LA"):
+                    cropped = cropped.convert(
+                        "RGBA" if "transparency" in cropped.info else "RGB")
+            buf = io.BytesIO()
+            cropped.save(buf, **save)
+            return buf.getvalue()
+
+        return self.crops.get_or_make(etag, make)
+
+
+class CropHandler(BaseHTTPRequestHandler):
+    server_version = "crop-server/1"
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        service = self.server.service
+        url = urlsplit(self.path)
+        if url.path == "/_stats":
+            data = json.dumps({"pages": service.pages.stats(),
+                               "crops": service.crops.stats()}).encode()
+            return self.reply(HTTPStatus.OK, data, "application/json", body)
+
+        match = URL_RE.fullmatch(url.path)
+        if not match:
+            return self.fail(HTTPStatus.NOT_FOUND,
+                             "expected /{product_id}.{png,webp,avif}", body)
+        prod_id, fmt = match.groups()
+        if fmt not in service.formats:
+            return self.fail(HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+                             f"this Pillow build cannot write {fmt}", body)
+        width = parse_qs(url.query).get("w", [None])[-1]
+        if width is not None:
+            if not width.isdigit() or int(width) < 1:
+                return self.fail(HTTPStatus.BAD_REQUEST,
+                                 "w must be a positive integer", body)
+            width = int(width)
+
+        try:
+            page_num, box = service.locate(prod_id)
+        except KeyError:
+            return self.fail(HTTPStatus.NOT_FOUND,
+                             f"{prod_id} is not in PAGE_CONFIGS", body)
+        except OSError as e:
+            return self.fail(HTTPStatus.NOT_FOUND, str(e), body)
+        if box is None:
+            return self.fail(HTTPStatus.NOT_FOUND,
+                             f"{prod_id}: no region detected", body)
+
+        try:
+            etag = service.etag(page_num, box, fmt, width)
+        except OSError as e:
+            return self.fail(HTTPStatus.NOT_FOUND, str(e), body)
+        if etag_matches(self.headers.get("If-None-Match"), etag):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", f'"{etag}"')
+            self.end_headers()
+            return
+        try:
+            data = service.render(page_num, box, fmt, width, etag)
+        except Exception as e:
+            return self.fail(HTTPStatus.INTERNAL_SERVER_ERROR, str(e), body)
+        self.reply(HTTPStatus.OK, data, CONTENT_TYPES[fmt], body, etag)
+
+    def reply(self, status, data, content_type, body=True, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        if etag:
+            self.send_header("ETag", f'"{etag}"')
+            # Revalidate every time, so edited pages and boxes show up on
+            # reload.
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def fail(self, status, message, body=True):
+        self.reply(status, (message + "\n").encode(),
+                   "text/plain; charset=utf-8", body)
+
+
+def etag_matches(header, etag):
+    """Whether an If-None-Match header value lists etag (weak or strong)."""
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or any(t.removeprefix("W/").strip('"') == etag
+                              for t in tags)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve product crops on demand from the catalog pages.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--page-cache", type=int, default=PAGE_CACHE_MB,
+                        metavar="MB", help="decoded pages kept in memory "
+                                           f"(default {PAGE_CACHE_MB} MB)")
+    parser.add_argument("--crop-cache", type=int, default=CROP_CACHE_MB,
+                        metavar="MB", help="encoded crops kept in memory "
+                                           f"(default {CROP_CACHE_MB} MB)")
+    parser.add_argument("--trim", action="store_true",
+                        help="trim crops to their content, as "
+                             "crop_products.py --trim does")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {"trim": (crop_products.TRIM_TOLERANCE,
+                        crop_products.TRIM_MARGIN) if args.trim else None}
+    server = ThreadingHTTPServer((args.host, args.port), CropHandler)
+    server.daemon_threads = True
+    server.service = CropService(args.page_cache, args.crop_cache, options)
+    print(f"Serving {len(server.service.products)} products on "
+          f"http://{args.host}:{server.server_address[1]}/ "
+          f"(formats: {', '.join(sorted(server.service.formats))})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped.")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
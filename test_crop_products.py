@@ -0,0 +1,580 @@
+"""
+Tests for crop_products.py: the vectorized crop geometry and the --batch
+array crops must match the one-box-at-a-time Pillow path exactly, and the
+runners (incremental, --jobs, --shard/--merge) must agree with a plain
+serial run on a small synthetic catalog.
+
+    python -m pytest test_crop_products.py
+"""
+import concurrent.futures
+import copy
+import io
+import json
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import crop_products
+import crop_server
+
+PAGE_MODES = ("L", "LA", "P", "RGB", "RGBA")
+
+
+def synthetic_page(mode, seed=0):
+    """A noisy IMG_W x IMG_H page in mode (P pages get a random palette)."""
+    rng = np.random.default_rng(seed)
+    h, w = crop_products.IMG_H, crop_products.IMG_W
+    bands = len(Image.new(mode, (1, 1)).getbands())
+    shape = (h, w) if bands == 1 else (h, w, bands)
+    pixels = rng.integers(0, 256, shape, dtype=np.uint8)
+    if mode == "P":
+        page = Image.fromarray(pixels, "L").convert("P")
+        page.putpalette(rng.integers(0, 256, 768, dtype=np.uint8).tobytes())
+        page.info["transparency"] = 7
+        return page
+    return Image.fromarray(pixels, mode)
+
+
+def random_grid(rng):
+    top = rng.randint(-20, 400)
+    left = rng.randint(-20, 200)
+    rows, cols = rng.randint(1, 6), rng.randint(1, 5)
+    products = [f"p{i}" for i in range(rows * cols)]
+    empty = rng.randint(0, min(2, len(products) - 1))
+    for i in rng.sample(range(len(products)), empty):
+        products[i] = None
+    return {"mode": "grid",
+            "content_area": (top, left, rng.randint(top + 200, 1800),
+                             rng.randint(left + 200, 1280)),
+            "rows": rows, "cols": cols,
+            "photo_ratio": rng.choice((0.5, 0.55, 0.6, 0.65, 0.7)),
+            "products": products}
+
+
+def random_manual(rng):
+    crops = []
+    for i in range(rng.randint(1, 12)):
+        t, l = rng.randint(-10, 1700), rng.randint(-10, 1200)
+        crops.append((f"m{i}", t, l, t + rng.randint(10, 400),
+                      l + rng.randint(10, 400)))
+    return {"mode": "manual", "crops": crops}
+
+
+def png(img):
+    buf = io.BytesIO()
+    img.save(buf, **crop_products.PNG_SAVE_OPTIONS)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_page_boxes_match_grid_box(seed):
+    config = random_grid(random.Random(seed))
+    ids, boxes = crop_products.page_boxes(config)
+    assert ids == config["products"]
+    expected = [crop_products.grid_box(
+        config["content_area"], config["rows"], config["cols"], i,
+        photo_ratio=config["photo_ratio"]) for i in range(len(ids))]
+    assert [tuple(box) for box in boxes.tolist()] == expected
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_page_boxes_match_region_box(seed):
+    config = random_manual(random.Random(seed))
+    ids, boxes = crop_products.page_boxes(config)
+    assert ids == [entry[0] for entry in config["crops"]]
+    expected = [crop_products.region_box(entry[1:])
+                for entry in config["crops"]]
+    assert [tuple(box) for box in boxes.tolist()] == expected
+
+
+def test_page_boxes_of_real_configs():
+    for config in crop_products.PAGE_CONFIGS.values():
+        if config["mode"] == "auto":
+            continue
+        ids, boxes = crop_products.page_boxes(config)
+        if config["mode"] == "manual":
+            expected = [crop_products.region_box(entry[1:])
+                        for entry in config["crops"]]
+        else:
+            expected = [crop_products.grid_box(
+                config["content_area"], config["rows"], config["cols"], i,
+                photo_ratio=config.get("photo_ratio", 0.60))
+                for i in range(len(ids))]
+        assert [tuple(box) for box in boxes.tolist()] == expected
+
+
+@pytest.mark.parametrize("mode", PAGE_MODES)
+def test_crop_views_match_image_crop(mode):
+    page = synthetic_page(mode, seed=len(mode))
+    rng = random.Random(mode)
+    configs = [random_grid(rng) for _ in range(3)]
+    configs += [random_manual(rng) for _ in range(3)]
+    boxes = np.concatenate([crop_products.page_boxes(c)[1] for c in configs])
+    # Boxes that would be empty or cross the page edge are not batched
+    w, h = page.size
+    boxes = boxes[(boxes[:, 0] < boxes[:, 2]) & (boxes[:, 1] < boxes[:, 3])
+                  & (boxes[:, 2] <= w) & (boxes[:, 3] <= h)]
+    assert len(boxes)
+
+    pixels = np.asarray(page)
+    for box, view in zip(boxes.tolist(),
+                         crop_products.crop_views(pixels, boxes)):
+        cropped = crop_products.view_to_image(view, page)
+        expected = page.crop(tuple(box))
+        assert cropped.mode == expected.mode
+        assert cropped.size == expected.size
+        assert cropped.tobytes() == expected.tobytes()
+        assert cropped.getpalette() == expected.getpalette()
+        assert png(cropped) == png(expected)
+
+
+@pytest.mark.parametrize("mode", PAGE_MODES)
+def test_batch_iter_crops_match_serial(mode):
+    page = synthetic_page(mode, seed=3)
+    _, boxes = crop_products.page_boxes(random_grid(random.Random(mode)))
+    serial = list(crop_products.iter_crops(page, boxes))
+    batch = list(crop_products.iter_crops(page, boxes, {"batch": True}))
+    assert len(serial) == len(batch)
+    for a, b in zip(serial, batch):
+        if isinstance(a, Exception):
+            assert isinstance(b, Exception)
+        else:
+            assert png(a) == png(b)
+
+
+def test_view_to_image_rejects_empty_crop():
+    page = synthetic_page("RGB")
+    view = crop_products.crop_views(np.asarray(page), [(10, 10, 10, 50)])[0]
+    with pytest.raises(ValueError):
+        crop_products.view_to_image(view, page)
+
+
+def test_ssim_error_sees_hue_shifts():
+    rng = np.random.default_rng(0)
+    rgb = rng.integers(60, 120, (64, 64, 3)).astype(np.float64)
+    # Trade red for blue at constant luma (ITU-R 601-2, as Pillow's "L")
+    shifted = rgb + [-38.0, 0.0, 100.0]
+    a, b = (Image.fromarray(np.round(x).astype(np.uint8))
+            for x in (rgb, shifted))
+    assert np.abs(np.asarray(a.convert("L"), dtype=int)
+                  - np.asarray(b.convert("L"), dtype=int)).max() <= 1
+    assert crop_products.ssim_error(a, a) == 0
+    assert crop_products.ssim_error(a, b) > crop_products.OPTIMIZE_MAX_ERROR
+
+
+# ── Catalog parsing ──
+
+CATALOG_JSON = """{
+  "store": {"name": "Panda \\"Depot\\"", "tags": ["]", "}", ","]},
+  "categories": [
+    {"name": "Rice", "products": [
+      {"id": "r-001", "name": "Jasmine rice 25lb", "price": 25.5e0},
+      {"id": "r-002", "name": "\u7cd9\u7c73 \\u00e9", "price": 1234567890}
+    ]},
+    {"name": "Empty", "products": []},
+    {"name": "Sauce", "products": [{"id": "s-001", "name": "Duck sauce",
+                                    "sizes": [1, 2.5, -3e-2, null, true]}]}
+  ],
+  "version": 12345
+}
+"""
+
+MALFORMED_CATALOGS = [
+    "",
+    "   \n  ",
+    '{"categories": [{"name": "a"}',
+    '{"categories": [{"name": "a"}]} x',
+    '{"categories": [{"name": "a"}]}\n\n  {}',
+    '{"categories": [{"name": tru}]}',
+    '{"categories": [{"name": "a"},]}',
+    '{"categories": [{"name": "a\n"}]}',
+    '{"categories": [{"name": "unterminated}]}',
+    '{1: 2, "categories": []}',
+    '{"categories": [], }',
+    '{"categories" []}',
+    '{\n  "categories": [\n    {"name": "a"}\n    {"name": "b"}\n  ]\n}',
+    '{\n  "categories": [\n    {"name": "a", "products": [1 2]}\n  ]\n}',
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 1 << 16])
+def test_iter_categories_matches_json_load(tmp_path, chunk_size):
+    path = tmp_path / "catalog.json"
+    path.write_text(CATALOG_JSON, encoding="utf-8")
+    assert list(crop_products.iter_categories(path, chunk_size)) == \
+        json.loads(CATALOG_JSON)["categories"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64])
+@pytest.mark.parametrize("text", MALFORMED_CATALOGS)
+def test_iter_categories_rejects_malformed_json(tmp_path, chunk_size, text):
+    path = tmp_path / "catalog.json"
+    path.write_text(text, encoding="utf-8")
+    with pytest.raises(json.JSONDecodeError) as streamed:
+        list(crop_products.iter_categories(path, chunk_size))
+    try:
+        expected = json.loads(text)["categories"]
+    except json.JSONDecodeError as e:
+        # Same place as json.load, counted in the whole file
+        assert (streamed.value.pos, streamed.value.lineno,
+                streamed.value.colno) == (e.pos, e.lineno, e.colno)
+    else:
+        pytest.fail(f"json.loads accepted {text!r}: {expected!r}")
+
+
+# ── Automatic region detection ──
+
+def captioned_page(seed=0):
+    """
+    A white page with a 2x3 grid of photos, each over three lines of bold
+    ring-shaped "glyphs" standing in for its caption and price.
+    Returns (image, photo boxes as (top, left, bottom, right)).
+    """
+    rng = np.random.default_rng(seed)
+    page = np.full((crop_products.IMG_H, crop_products.IMG_W, 3), 255,
+                   dtype=np.uint8)
+    photos = []
+    for y in (300, 900):
+        for x in (150, 550, 950):
+            page[y:y + 220, x:x + 200] = rng.integers(30, 200, 3)
+            photos.append((y, x, y + 220, x + 200))
+            for line in range(3):
+                gy = y + 240 + line * 30
+                for gx in range(x, x + 200, 20):
+                    page[gy:gy + 20, gx:gx + 16] = 0
+                    page[gy + 4:gy + 16, gx + 4:gx + 12] = 255
+    return Image.fromarray(page), photos
+
+
+def test_label_components_is_four_connected():
+    mask = np.array([
+        [1, 1, 0, 0, 1],
+        [0, 1, 0, 1, 0],
+        [0, 1, 1, 1, 0],
+        [0, 0, 0, 0, 0],
+        [1, 0, 1, 1, 0],
+    ], dtype=bool)
+    labels, count = crop_products.label_components(mask)
+    assert count == 4
+    assert (labels == 0).tolist() == (~mask).tolist()
+    # The U is one component; its diagonal neighbour at (0, 4) is not.
+    assert len({labels[0, 0], labels[2, 2], labels[1, 3]}) == 1
+    assert labels[0, 4] != labels[1, 3]
+    assert labels[4, 2] == labels[4, 3] != labels[4, 0]
+
+
+def test_detect_regions_skips_caption_text():
+    img, photos = captioned_page()
+    regions = crop_products.detect_regions(img)
+    assert len(regions) == len(photos)
+    margin = crop_products.AUTO_MARGIN
+    for (t, l, b, r), photo in zip(regions.tolist(), photos):
+        assert abs(t + margin - photo[0]) <= crop_products.AUTO_SCALE
+        assert abs(l + margin - photo[1]) <= crop_products.AUTO_SCALE
+        assert abs(b - margin - photo[2]) <= crop_products.AUTO_SCALE
+        assert abs(r - margin - photo[3]) <= crop_products.AUTO_SCALE
+
+
+def test_detect_regions_stays_in_content_area():
+    img, photos = captioned_page()
+    regions = crop_products.detect_regions(img, (0, 0, 700, 1241))
+    assert len(regions) == 3
+    assert (regions[:, 2] <= 700 + crop_products.AUTO_MARGIN).all()
+
+
+# ── Runs on a synthetic catalog ──
+
+CATALOG_CONFIGS = {
+    1: {"mode": "grid", "content_area": (200, 100, 1400, 1100),
+        "rows": 2, "cols": 2, "photo_ratio": 0.6,
+        "products": ["a-001", "a-002", "a-003", "a-004"]},
+    2: {"mode": "manual", "crops": [("b-001", 300, 100, 600, 500),
+                                    ("b-002", 300, 600, 600, 1000),
+                                    ("b-003", 900, 300, 1300, 800)]},
+    3: {"mode": "grid", "content_area": (400, 100, 1000, 1100),
+        "rows": 1, "cols": 2, "photo_ratio": 0.7,
+        "products": ["c-001", "c-002"]},
+}
+
+
+def photo_page(seed):
+    """A white reference-size page with a soft coloured block per region."""
+    rng = np.random.default_rng(seed)
+    page = np.full((crop_products.IMG_H, crop_products.IMG_W, 3), 255,
+                   dtype=np.uint8)
+    for y in range(250, 1500, 300):
+        for x in range(150, 1100, 250):
+            color = rng.integers(30, 220, 3)
+            ramp = np.linspace(0, 40, 180)[None, :, None]
+            page[y:y + 200, x:x + 180] = np.clip(color + ramp, 0, 255)
+    return Image.fromarray(page)
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    """
+    Point crop_products at a three-page synthetic catalog under tmp_path
+    (caches included, as they live under the working directory).
+    """
+    monkeypatch.chdir(tmp_path)
+    images = tmp_path / "images"
+    images.mkdir()
+    for page_num in CATALOG_CONFIGS:
+        photo_page(page_num).save(images / f"page-{page_num:02d}.png")
+    ids = [prod_id for config in CATALOG_CONFIGS.values()
+           for prod_id in crop_products.page_products(config)]
+    with open(tmp_path / "catalog.json", "w") as f:
+        json.dump({"categories": [{"name": "Test", "products": [
+            {"id": prod_id, "name": f"Product {prod_id}"}
+            for prod_id in ids]}]}, f)
+    monkeypatch.setattr(crop_products, "IMAGES_DIR", str(images))
+    monkeypatch.setattr(crop_products, "CATALOG_PATH",
+                        str(tmp_path / "catalog.json"))
+    monkeypatch.setattr(crop_products, "OUTPUT_DIR", str(tmp_path / "out"))
+    monkeypatch.setattr(crop_products, "PAGE_CONFIGS",
+                        copy.deepcopy(CATALOG_CONFIGS))
+    return tmp_path
+
+
+def outputs(out_dir=None):
+    """{filename: bytes} of the PNG outputs in out_dir (OUTPUT_DIR)."""
+    out_dir = out_dir or crop_products.OUTPUT_DIR
+    result = {}
+    for name in sorted(os.listdir(out_dir)):
+        if name.endswith(".png"):
+            with open(os.path.join(out_dir, name), "rb") as f:
+                result[name] = f.read()
+    return result
+
+
+def manifest_files():
+    return crop_products.load_manifest(os.path.join(
+        crop_products.OUTPUT_DIR, crop_products.MANIFEST_NAME))["files"]
+
+
+def test_crop_key_covers_its_inputs():
+    key = crop_products.crop_key("d" * 64, (1, 2, 3, 4), "x.png")
+    assert key == crop_products.crop_key("d" * 64, [1, 2, 3, 4], "x.png")
+    assert key != crop_products.crop_key("e" * 64, (1, 2, 3, 4), "x.png")
+    assert key != crop_products.crop_key("d" * 64, (1, 2, 3, 5), "x.png")
+    assert key != crop_products.crop_key("d" * 64, (1, 2, 3, 4), "y.png")
+    assert key != crop_products.crop_key("d" * 64, (1, 2, 3, 4), "x.png",
+                                         {"trim": (16, 6)})
+
+
+def test_incremental_run_skips_and_invalidates(catalog, capsys):
+    crop_products.main([])
+    first = outputs()
+    assert len(first) == 9
+    assert set(manifest_files()) == set(first)
+    mtimes = {name: os.stat(os.path.join(crop_products.OUTPUT_DIR,
+                                         name)).st_mtime_ns for name in first}
+    capsys.readouterr()
+
+    crop_products.main([])
+    assert "Cropped 0 product images" in capsys.readouterr().out
+    assert {name: os.stat(os.path.join(crop_products.OUTPUT_DIR,
+                                       name)).st_mtime_ns
+            for name in first} == mtimes
+
+    # A changed page re-crops that page only; a changed box that product
+    photo_page(99).save(catalog / "images" / "page-03.png")
+    crop_products.PAGE_CONFIGS[2]["crops"][0] = ("b-001", 310, 100, 600, 500)
+    crop_products.main([])
+    out = capsys.readouterr().out
+    assert "Cropped 3 product images" in out
+    assert "Unchanged: 6" in out
+    changed = {name for name, data in outputs().items()
+               if data != first[name]}
+    assert {name.split("_")[0] for name in changed} == {
+        "b-001", "c-001", "c-002"}
+
+    # A deleted output is re-made, a product no config has is pruned
+    os.remove(os.path.join(crop_products.OUTPUT_DIR, sorted(first)[0]))
+    del crop_products.PAGE_CONFIGS[3]
+    crop_products.main([])
+    out = capsys.readouterr().out
+    assert "Cropped 1 product images" in out
+    assert sorted(outputs()) == sorted(name for name in first
+                                       if not name.startswith("c-"))
+    assert set(manifest_files()) == set(outputs())
+
+
+def test_jobs_match_serial(catalog, monkeypatch):
+    crop_products.main([])
+    serial, serial_files = outputs(), manifest_files()
+    monkeypatch.setattr(crop_products, "OUTPUT_DIR", str(catalog / "jobs"))
+    crop_products.main(["--jobs", "2"])
+    assert outputs() == serial
+    assert manifest_files() == serial_files
+
+
+def test_jobs_under_spawn_use_the_parent_paths(catalog, monkeypatch):
+    # Spawned workers import crop_products afresh, with its default paths
+    spawn = multiprocessing.get_context("spawn")
+    pool = concurrent.futures.ProcessPoolExecutor
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor",
+                        lambda **kw: pool(mp_context=spawn, **kw))
+    crop_products.main(["--jobs", "2"])
+    assert len(outputs()) == 9
+    assert not os.path.exists(catalog / "src")
+
+
+@pytest.mark.parametrize("args", [[], ["--jobs", "2"], ["--batch"],
+                                  ["--raw-cache", "raw"], ["--pipeline"]])
+def test_truncated_page_fails_its_products(catalog, capsys, args):
+    path = catalog / "images" / "page-02.png"
+    data = path.read_bytes()
+    path.write_bytes(data[:len(data) // 2])
+    crop_products.main(args)
+    out = capsys.readouterr().out
+    assert "Cropped 6 product images" in out
+    assert "Failed: 3" in out
+    assert sorted(name.split("_")[0] for name in outputs()) == [
+        "a-001", "a-002", "a-003", "a-004", "c-001", "c-002"]
+    assert set(manifest_files()) == set(outputs())
+
+
+def test_iter_product_crops_yields_decode_errors(catalog):
+    path = catalog / "images" / "page-02.png"
+    data = path.read_bytes()
+    path.write_bytes(data[:len(data) // 2])
+    crops = {prod_id: crop for prod_id, _, crop
+             in crop_products.iter_product_crops()}
+    assert len(crops) == 9
+    assert {prod_id for prod_id, crop in crops.items()
+            if isinstance(crop, Exception)} == {"b-001", "b-002", "b-003"}
+
+
+@pytest.mark.parametrize("args", [["--raw-cache", "raw"],
+                                  ["--raw-cache", "raw", "--pipeline"]])
+def test_raw_cache_hashes_each_page_once(catalog, monkeypatch, args):
+    hashed = []
+    file_digest = crop_products.file_digest
+    monkeypatch.setattr(crop_products, "file_digest",
+                        lambda path: hashed.append(path) or file_digest(path))
+    crop_products.main(args)
+    pages = [path for path in hashed if "page-" in os.path.basename(path)]
+    assert len(pages) == len(CATALOG_CONFIGS) == len(set(pages))
+
+
+def test_shards_merge_to_a_serial_run(catalog, monkeypatch):
+    crop_products.main([])
+    serial, serial_files = outputs(), manifest_files()
+
+    pages = [crop_products.shard_pages(crop_products.PAGE_CONFIGS, i, 2)
+             for i in (1, 2)]
+    assert sorted(pages[0] + pages[1]) == sorted(CATALOG_CONFIGS)
+    assert pages[0] and pages[1]
+
+    monkeypatch.setattr(crop_products, "OUTPUT_DIR", str(catalog / "shards"))
+    crop_products.main(["--shard", "1/2"])
+    crop_products.main(["--shard", "2/2"])
+    assert not os.path.exists(os.path.join(crop_products.OUTPUT_DIR,
+                                           crop_products.MANIFEST_NAME))
+    crop_products.main(["--merge"])
+    assert outputs() == serial
+    assert manifest_files() == serial_files
+    assert not any(crop_products.SHARD_RE.match(name)
+                   for name in os.listdir(crop_products.OUTPUT_DIR))
+
+
+def test_dedupe_stores_a_shared_crop_once(catalog, monkeypatch, capsys):
+    # Page 2 is a noisy rescan of page 1 and b-001 has a-001's box there
+    page = np.asarray(photo_page(1)).astype(int)
+    noise = np.random.default_rng(0).integers(-2, 3, page.shape)
+    Image.fromarray(np.clip(page + noise, 0, 255).astype(np.uint8)).save(
+        catalog / "images" / "page-02.png")
+    x1, y1, x2, y2 = crop_products.page_boxes(CATALOG_CONFIGS[1])[1][0]
+    crop_products.PAGE_CONFIGS[2]["crops"][0] = (
+        "b-001", int(y1) - 3, int(x1) - 3, int(y2) + 3, int(x2) + 3)
+    monkeypatch.setattr(crop_products, "DEDUPE_JSON_PATH",
+                        str(catalog / "dedupe.json"))
+    placeholders = catalog / "placeholders.json"
+    args = ["--dedupe", "--placeholders", "--placeholders-json",
+            str(placeholders)]
+    asset, member = "a-001_product-a-001.png", "b-001_product-b-001.png"
+
+    crop_products.main(args)
+    assert asset in outputs() and member not in outputs()
+    assert manifest_files()[member]["asset"] == asset
+    with open(catalog / "dedupe.json") as f:
+        assert json.load(f)["assets"] == {"a-001": asset, "b-001": asset}
+    with open(placeholders) as f:
+        products = json.load(f)["products"]
+    assert products["b-001"] == products["a-001"]
+    assert crop_products.report() == 0
+    capsys.readouterr()
+
+    # Later runs keep it stored once while the asset is there
+    crop_products.main([])
+    assert "Cropped 0 product images" in capsys.readouterr().out
+    assert member not in outputs()
+
+    # Once the asset changes the member gets its own crop back
+    photo_page(99).save(catalog / "images" / "page-01.png")
+    crop_products.main(args)
+    assert "b-001_product-b-001.png no longer matches" in \
+        capsys.readouterr().out
+    assert member not in manifest_files()
+    crop_products.main(args)
+    assert member in outputs()
+    assert "asset" not in manifest_files()[member]
+
+
+def test_lru_cache_makes_a_value_once_under_concurrency():
+    cache = crop_server.LRUCache(1000, len)
+    calls = []
+
+    def make():
+        calls.append(1)
+        time.sleep(0.05)
+        return b"value"
+
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(cache.get_or_make("k", make)))
+        for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [b"value"] * 20
+    assert cache.loading == {}
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = crop_server.LRUCache(10, len)
+    cache.get_or_make("a", lambda: b"aaaa")
+    cache.get_or_make("b", lambda: b"bbbb")
+    cache.get_or_make("a", lambda: b"xxxx")      # a is now the most recent
+    cache.get_or_make("c", lambda: b"cccc")
+    assert list(cache.items) == ["a", "c"]
+    assert cache.bytes == 8
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_pack_shelves_does_not_overlap(seed):
+    rng = random.Random(seed)
+    sizes = [(rng.randint(1, 160), rng.randint(1, 160))
+             for _ in range(rng.randint(1, 200))]
+    places, sheets = crop_products.pack_shelves(sizes, 512, 384, padding=2)
+    assert len(places) == len(sizes)
+    rects = {}
+    for (w, h), (sheet, x, y) in zip(sizes, places):
+        sheet_w, sheet_h = sheets[sheet]
+        assert 0 <= x and x + w <= min(sheet_w, 512)
+        assert 0 <= y and y + h <= min(sheet_h, 384)
+        rects.setdefault(sheet, []).append((x, y, x + w, y + h))
+    for boxes in rects.values():
+        for i, (x1, y1, x2, y2) in enumerate(boxes):
+            for a1, b1, a2, b2 in boxes[i + 1:]:
+                assert x2 + 2 <= a1 or a2 + 2 <= x1 or y2 + 2 <= b1 \
+                    or b2 + 2 <= y1